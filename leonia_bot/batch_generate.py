@@ -0,0 +1,167 @@
+"""This is a command line tool that answers the prompts in a JSONL file with a
+model, e.g., for regression checks and demos. Each line of the input file is
+an object with a `prompt` and, optionally, an `id`. Each prompt is answered as
+the first message of a new conversation. The results are written to the
+output file as soon as they are ready, one object per line with the `id`, the
+`prompt`, the `answer`, the `latency_sec` and the `metrics` of the generation,
+in the order they finish. A line that cannot be read, or a prompt that cannot
+be answered, gets an object with the `id` and the `error` instead, and the tool
+exits with an error status once the other prompts are answered.
+
+The input file is read as the prompts are answered, so it can be of any size.
+Up to `--batch-size` prompts are answered at the same time, and their decoding
+steps are run in padded batches if the model configuration allows padding and
+has no draft model.
+
+Run it from the root of the repository with, e.g.:
+
+    python leonia_bot/batch_generate.py --model DISTILGPT2 prompts.jsonl out.jsonl
+"""
+
+import argparse
+import json
+import sys
+from threading import Lock, Thread
+import time
+from typing import Iterator, Optional, TextIO, Tuple
+
+from chat_bot import ChatBot, ChatBotConf
+from model_configurations import ModelConfigurations
+
+
+# The id, the prompt and the error, if any, of a line of the input file
+PromptItem = Tuple[object, Optional[str], Optional[str]]
+
+
+def read_prompts(input_file: TextIO) -> Iterator[PromptItem]:
+    """This function yields the id, the prompt and the error, if any, of each
+    line of the file, reading one line at a time. Lines without an id get
+    their line number. Lines that are not an object with a prompt have no
+    prompt, and the error says why."""
+    for line_number, line in enumerate(input_file, start=1):
+        if not line.strip():
+            continue
+
+        try:
+            item = json.loads(line)
+        except ValueError as error:
+            yield line_number, None, f"Invalid JSON in line {line_number}: {error}"
+            continue
+        if not isinstance(item, dict) or not isinstance(item.get("prompt"), str):
+            yield line_number, None, f'Line {line_number} has no "prompt" string'
+            continue
+
+        yield item.get("id", line_number), item["prompt"], None
+
+
+class BatchGenerator:
+    """This class answers the prompts with a pool of conversations with the
+    same model, each one in its own thread."""
+
+    def __init__(self, chat_bot: ChatBot, batch_size: int):
+        self.chat_bot = chat_bot
+        self.batch_size = batch_size
+        self.lock = Lock()
+        self.num_done = 0
+        self.num_failed = 0
+
+    def run(self, prompts: Iterator[PromptItem], output_file: TextIO):
+        """This function answers all the prompts, writing the results to the
+        output file. Failures are written as errors and counted in
+        `num_failed`."""
+        self.chat_bot.enable_batching()
+        threads = [
+            Thread(target=self._answer_all, args=(prompts, output_file))
+            for _ in range(self.batch_size)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _answer_all(self, prompts: Iterator[PromptItem], output_file: TextIO):
+        chat_bot = self.chat_bot.fork()
+        while True:
+            # The prompts are shared by all the threads
+            with self.lock:
+                item = next(prompts, None)
+            if item is None:
+                return
+
+            item_id, prompt, error = item
+            if error is None:
+                try:
+                    result = self._answer(chat_bot, item_id, prompt)
+                except Exception as answer_error:  # pylint: disable=broad-except
+                    error = repr(answer_error)
+            if error is not None:
+                result = {"id": item_id, "prompt": prompt, "error": error}
+
+            with self.lock:
+                output_file.write(json.dumps(result) + "\n")
+                output_file.flush()
+                if error is None:
+                    self.num_done += 1
+                    print(f"{self.num_done} prompts answered", file=sys.stderr)
+                else:
+                    self.num_failed += 1
+                    print(f"Error in prompt {item_id}: {error}", file=sys.stderr)
+
+    @staticmethod
+    def _answer(chat_bot: ChatBot, item_id, prompt: str) -> dict:
+        """This function answers a prompt in a new conversation and returns
+        the result."""
+        start = time.time()
+        chat_bot.reset()
+        answer = "".join(chat_bot.get_answer(prompt))
+
+        return {
+            "id": item_id,
+            "prompt": prompt,
+            "answer": answer,
+            "latency_sec": round(time.time() - start, 3),
+            "metrics": chat_bot.last_metrics.to_dict(),
+        }
+
+
+def main():
+    """This function parses the command line and answers the prompts."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("input", help="JSONL file with the prompts")
+    parser.add_argument("output", help="JSONL file for the results")
+    parser.add_argument("--model", default="DISTILGPT2")
+    parser.add_argument("--conf", default="model_confs.yaml")
+    parser.add_argument("--batch-size", type=int, default=8)
+    args = parser.parse_args()
+
+    model_confs = ModelConfigurations(args.conf)
+    # Check the model name before loading anything
+    conf = ChatBotConf(args.model, model_confs)
+    if args.batch_size > 1 and (not conf.padding or conf.draft_repo is not None):
+        print(
+            f"Warning: {args.model} does not allow padding or has a draft model,"
+            f" so its decoding steps cannot be batched. The prompts are answered"
+            f" {args.batch_size} at a time, but each step runs on its own.",
+            file=sys.stderr,
+        )
+
+    chat_bot = ChatBot(args.model, model_confs)
+    chat_bot.initialize()
+
+    with open(args.input, "r", encoding="utf-8") as input_file, open(
+        args.output, "w", encoding="utf-8"
+    ) as output_file:
+        generator = BatchGenerator(chat_bot, args.batch_size)
+        generator.run(read_prompts(input_file), output_file)
+
+    if generator.num_failed:
+        print(
+            f"{generator.num_failed} prompts failed, see the errors in"
+            f" {args.output}",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+"""This module defines the `BatchScheduler` class, which merges the decoding
+steps of several conversations with the same model into a single batched
+forward pass."""
+
+from concurrent.futures import Future
+from queue import Empty, Queue
+from threading import Lock, Thread
+import time
+from typing import Dict, List, Tuple
+
+import torch
+
+from cached_model import CachedModel
+
+# How long a step waits for the conversations in the batch to ask for their
+# next token before running without them
+MAX_WAIT_SEC = 0.005
+
+
+def _pad_cache(tensor: torch.Tensor, length: int) -> torch.Tensor:
+    """This function pads cached keys or values, of shape (batch, heads,
+    tokens, head size), on the left up to `length` tokens."""
+    batch, heads, tokens, head_size = tensor.shape
+    if tokens == length:
+        return tensor
+
+    padding = torch.zeros(
+        (batch, heads, length - tokens, head_size), dtype=tensor.dtype
+    )
+    return torch.cat([padding, tensor], dim=2)
+
+
+def _cat_padded(first: torch.Tensor, second: torch.Tensor, length: int):
+    """This function pads the cached keys or values of two batches to `length`
+    tokens and joins them in a single batch."""
+    return torch.cat([_pad_cache(first, length), _pad_cache(second, length)])
+
+
+def _pad_mask(mask: torch.Tensor, length: int) -> torch.Tensor:
+    """This function pads an attention mask, of shape (batch, tokens), on the
+    left up to `length` tokens with zeros, which hide the padding."""
+    batch, tokens = mask.shape
+    padding = torch.zeros((batch, length - tokens), dtype=mask.dtype)
+    return torch.cat([padding, mask], dim=1)
+
+
+class BatchScheduler:
+    """This class runs the decoding steps of the conversations with a model.
+    Conversations join the batch when they ask for a token and leave it when
+    their answer ends, or when they do not ask for the next token in time.
+    The batch keeps the cached keys and values of its members left-padded to
+    the same length, with an attention mask that hides the padding and
+    position ids that follow the real length of each conversation, so the
+    keys and values are only copied when a conversation joins or leaves."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.requests = Queue()
+        # The thread runs only while there are conversations to serve, so it
+        # does not keep an unused model alive
+        self.lock = Lock()
+        self.running = False
+
+        # The batch, which only the thread of the scheduler touches
+        self.members: List[CachedModel] = []
+        self.lengths: List[int] = []
+        self.past_key_values = None
+        self.attention_mask = None
+
+    def _submit(self, request: Tuple) -> Future:
+        future = Future()
+        with self.lock:
+            self.requests.put((*request, future))
+            if not self.running:
+                self.running = True
+                Thread(target=self._run, daemon=True).start()
+
+        return future
+
+    def decode(self, cached_model: CachedModel, token: int) -> torch.Tensor:
+        """This function runs the model over the next token of the given
+        conversation, in a batch with the other conversations, and returns the
+        logits for it. Until `release` is called, the cached keys and values
+        of the conversation are kept in the batch."""
+        return self._submit(("decode", cached_model, token)).result()
+
+    def release(self, cached_model: CachedModel) -> None:
+        """This function takes the given conversation out of the batch, giving
+        back its cached keys and values."""
+        self._submit(("release", cached_model)).result()
+
+    def _run(self) -> None:
+        while True:
+            with self.lock:
+                if not self.members and self.requests.empty():
+                    self.running = False
+                    return
+
+            pending = self._collect()
+            if pending:
+                self._step(pending)
+
+    def _collect(self) -> Dict[CachedModel, Tuple[int, Future]]:
+        """This function gathers the requests for the next step. It waits until
+        every member of the batch has asked for its next token, for at most
+        `MAX_WAIT_SEC` after the first request."""
+        pending = {}
+        deadline = None
+        while True:
+            if deadline is None:
+                timeout = 1.0
+            else:
+                timeout = deadline - time.time()
+                if timeout <= 0 or all(member in pending for member in self.members):
+                    return pending
+
+            try:
+                kind, cached_model, *args = self.requests.get(timeout=timeout)
+            except Empty:
+                if deadline is None and not self.members:
+                    return pending
+                continue
+
+            if kind == "release":
+                future = args[0]
+                if cached_model in self.members:
+                    self._leave(self.members.index(cached_model))
+                future.set_result(None)
+            else:
+                pending[cached_model] = args
+                if deadline is None:
+                    deadline = time.time() + MAX_WAIT_SEC
+
+    def _join(self, cached_model: CachedModel) -> None:
+        length = len(cached_model.cache_ids)
+        padded_length = max(length, max(self.lengths, default=0))
+        mask = torch.ones((1, length), dtype=torch.long)
+
+        if not self.members:
+            self.past_key_values = cached_model.past_key_values
+            self.attention_mask = mask
+        else:
+            self.past_key_values = tuple(
+                (
+                    _cat_padded(key, new_key, padded_length),
+                    _cat_padded(value, new_value, padded_length),
+                )
+                for (key, value), (new_key, new_value) in zip(
+                    self.past_key_values, cached_model.past_key_values
+                )
+            )
+            self.attention_mask = torch.cat(
+                [
+                    _pad_mask(self.attention_mask, padded_length),
+                    _pad_mask(mask, padded_length),
+                ]
+            )
+
+        self.members.append(cached_model)
+        self.lengths.append(length)
+
+    def _leave(self, index: int) -> None:
+        cached_model = self.members.pop(index)
+        length = self.lengths.pop(index)
+
+        # Give back the keys and values of the conversation without padding.
+        # They are copied, as views would keep the tensors of the whole batch
+        # in memory for as long as the conversation lasts.
+        cached_model.past_key_values = tuple(
+            (
+                key[index : index + 1, :, -length:].clone(),
+                value[index : index + 1, :, -length:].clone(),
+            )
+            for key, value in self.past_key_values
+        )
+
+        if not self.members:
+            self.past_key_values = None
+            self.attention_mask = None
+            return
+
+        # Drop its row and the padding no other member needs
+        rows = torch.tensor([i for i in range(len(self.members) + 1) if i != index])
+        padded_length = max(self.lengths)
+        self.past_key_values = tuple(
+            (
+                key.index_select(0, rows)[:, :, -padded_length:],
+                value.index_select(0, rows)[:, :, -padded_length:],
+            )
+            for key, value in self.past_key_values
+        )
+        self.attention_mask = self.attention_mask.index_select(0, rows)[
+            :, -padded_length:
+        ]
+
+    def _step(self, pending: Dict[CachedModel, Tuple[int, Future]]) -> None:
+        # Members that did not ask for a token leave, and new ones join
+        for index in reversed(range(len(self.members))):
+            if self.members[index] not in pending:
+                self._leave(index)
+        for cached_model in pending:
+            if cached_model not in self.members:
+                self._join(cached_model)
+
+        tokens = [pending[member][0] for member in self.members]
+        futures = [pending[member][1] for member in self.members]
+        try:
+            attention_mask = torch.cat(
+                [
+                    self.attention_mask,
+                    torch.ones((len(self.members), 1), dtype=torch.long),
+                ],
+                dim=1,
+            )
+            logits, past_key_values = self.backend.forward(
+                input_ids=torch.tensor(tokens).unsqueeze(1),
+                past_key_values=self.past_key_values,
+                attention_mask=attention_mask,
+                position_ids=torch.tensor(self.lengths).unsqueeze(1),
+            )
+        except Exception as error:  # pylint: disable=broad-except
+            for future in futures:
+                future.set_exception(error)
+            return
+
+        self.past_key_values = past_key_values
+        self.attention_mask = attention_mask
+
+        logits = logits[:, -1]
+        for index, (member, token, future) in enumerate(
+            zip(self.members, tokens, futures)
+        ):
+            self.lengths[index] += 1
+            member.cache_ids.append(token)
+            future.set_result(logits[index])
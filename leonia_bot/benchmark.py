@@ -0,0 +1,264 @@
+"""This is a benchmark of the latency of the chat bot as the conversation
+grows. It holds a scripted conversation with a model and measures, for each
+turn, the time to the first token and to the first fragment of the answer, the
+prefill and decoding times, the decoding speed, the cache hits and the peak
+memory. The report is written as JSON,
+so that runs can be compared, e.g., before and after a change.
+
+By default, it uses a tiny model with random weights, built locally the first
+time, so it runs without downloading anything. Any model of
+`model_confs.yaml` that is already downloaded can be used instead. Run it
+from the root of the repository with, e.g.:
+
+    python leonia_bot/benchmark.py --turns 20 --output after.json --baseline before.json
+"""
+
+import os
+
+# Never download anything: the tiny model is built locally, and other models
+# must be in the cache already
+os.environ.setdefault("HF_HUB_OFFLINE", "1")
+
+# pylint: disable=wrong-import-position
+import argparse
+import json
+import platform
+import time
+from typing import List, Optional
+
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+import transformers
+from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+import yaml
+
+from chat_bot import INITIAL_PROMPT, ChatBot, peak_rss_gb
+from model_configurations import ModelConfigurations
+
+TINY_MODEL_NAME = "TINY_RANDOM"
+TINY_MODEL_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "leonia_bot",
+    "benchmark",
+    "tiny-random",
+)
+
+TOKEN_END = "<|endoftext|>"
+TOKEN_HUMAN = "<|prompter|>"
+TOKEN_BOT = "<|assistant|>"
+
+# The messages of the scripted conversation, repeated as needed
+MESSAGES = [
+    "Hi! Can you help me plan a trip to Japan in spring?",
+    "What cities should I visit if I have ten days?",
+    "How do I get from Tokyo to Kyoto?",
+    "Is it worth buying a rail pass for that?",
+    "What food should I try in Osaka?",
+    "Can you summarize the plan so far?",
+]
+
+# The metrics compared with the baseline, and whether higher is better
+SUMMARY_METRICS = {
+    "mean_time_to_first_token_sec": False,
+    "mean_time_to_first_fragment_sec": False,
+    "mean_prefill_sec": False,
+    "mean_decode_tokens_per_sec": True,
+    "draft_acceptance_rate": True,
+    "peak_rss_gb": False,
+}
+
+
+def build_tiny_model(path: str) -> None:
+    """This function builds a tiny GPT-2 model with random weights and a
+    byte-level BPE tokenizer trained on the prompts, and stores them in the
+    given directory, so that `from_pretrained` can load them."""
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=1000,
+        special_tokens=[TOKEN_END, TOKEN_HUMAN, TOKEN_BOT],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+    )
+    tokenizer.train_from_iterator([INITIAL_PROMPT] + MESSAGES, trainer)
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token=TOKEN_END)
+
+    config = GPT2Config(
+        vocab_size=len(tokenizer),
+        n_positions=2048,
+        n_embd=128,
+        n_layer=4,
+        n_head=4,
+        bos_token_id=tokenizer.eos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    )
+    torch.manual_seed(0)
+    model = GPT2LMHeadModel(config)
+
+    model.save_pretrained(path)
+    tokenizer.save_pretrained(path)
+
+    conf = {
+        TINY_MODEL_NAME: {
+            "do_sample": True,
+            "max_context_tokens": 2048,
+            "max_new_tokens": 64,
+            "padding": True,
+            "repo": path,
+            "token_bot": TOKEN_BOT,
+            "token_end": TOKEN_END,
+            "token_human": TOKEN_HUMAN,
+            "top_k": 50,
+            "top_p": 0.95,
+        }
+    }
+    with open(os.path.join(path, "model_confs.yaml"), "w", encoding="utf-8") as f:
+        yaml.safe_dump(conf, f)
+
+
+def tiny_model_confs() -> ModelConfigurations:
+    """This function returns the configuration of the tiny model, building it
+    if needed."""
+    if not os.path.exists(os.path.join(TINY_MODEL_DIR, "model_confs.yaml")):
+        print(f"Building a tiny random model in {TINY_MODEL_DIR}")
+        os.makedirs(TINY_MODEL_DIR, exist_ok=True)
+        build_tiny_model(TINY_MODEL_DIR)
+
+    return ModelConfigurations(os.path.join(TINY_MODEL_DIR, "model_confs.yaml"))
+
+
+def run_conversation(chat_bot: ChatBot, num_turns: int) -> List[dict]:
+    """This function holds the scripted conversation and returns the metrics
+    of each turn."""
+    turns = []
+    for turn in range(num_turns):
+        message = MESSAGES[turn % len(MESSAGES)]
+        context_tokens = chat_bot.context.num_tokens()
+
+        start = time.perf_counter()
+        first_fragment_sec = None
+        for _ in chat_bot.get_answer(message):
+            if first_fragment_sec is None:
+                first_fragment_sec = time.perf_counter() - start
+        total_sec = time.perf_counter() - start
+
+        metrics = chat_bot.last_metrics
+        turns.append(
+            {
+                "turn": turn + 1,
+                "context_tokens": context_tokens,
+                "prompt_tokens": metrics.prompt_tokens,
+                "cached_tokens": metrics.cached_tokens,
+                "generated_tokens": metrics.generated_tokens,
+                "time_to_first_token_sec": metrics.time_to_first_token_sec,
+                "time_to_first_fragment_sec": first_fragment_sec,
+                "total_sec": total_sec,
+                "prefill_sec": metrics.prefill_sec,
+                "decode_sec": metrics.decode_sec,
+                "decode_tokens_per_sec": metrics.decode_tokens_per_sec(),
+                "draft_proposed_tokens": metrics.draft_proposed_tokens,
+                "draft_accepted_tokens": metrics.draft_accepted_tokens,
+                "peak_rss_gb": peak_rss_gb(),
+            }
+        )
+        print(
+            f"Turn {turn + 1}: {context_tokens} context tokens,"
+            f" first fragment in {first_fragment_sec or 0:.3f} sec"
+        )
+
+    return turns
+
+
+def _mean(values: List[Optional[float]]) -> Optional[float]:
+    values = [value for value in values if value is not None]
+    return sum(values) / len(values) if values else None
+
+
+def summarize(turns: List[dict]) -> dict:
+    """This function returns the summary of the metrics of all the turns."""
+    return {
+        "mean_time_to_first_token_sec": _mean(
+            [turn["time_to_first_token_sec"] for turn in turns]
+        ),
+        "mean_time_to_first_fragment_sec": _mean(
+            [turn["time_to_first_fragment_sec"] for turn in turns]
+        ),
+        "mean_prefill_sec": _mean([turn["prefill_sec"] for turn in turns]),
+        "mean_decode_tokens_per_sec": _mean(
+            [turn["decode_tokens_per_sec"] for turn in turns]
+        ),
+        "peak_rss_gb": turns[-1]["peak_rss_gb"] if turns else None,
+        # None if the model has no draft model
+        "draft_acceptance_rate": (
+            sum(turn["draft_accepted_tokens"] for turn in turns)
+            / sum(turn["draft_proposed_tokens"] for turn in turns)
+            if any(turn["draft_proposed_tokens"] for turn in turns)
+            else None
+        ),
+    }
+
+
+def compare(summary: dict, baseline: dict) -> None:
+    """This function prints the change of each metric of the summary with
+    respect to the summary of a baseline report."""
+    for metric, higher_is_better in SUMMARY_METRICS.items():
+        new, old = summary.get(metric), baseline.get(metric)
+        if not new or not old:
+            continue
+
+        change = (new - old) / old
+        better = change > 0 if higher_is_better else change < 0
+        verdict = "better" if better else "worse"
+        print(f"{metric}: {old:.4g} -> {new:.4g} ({change:+.1%}, {verdict})")
+
+
+def main():
+    """This function parses the command line and runs the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--model",
+        default=TINY_MODEL_NAME,
+        help=f"a model of the configuration file, or {TINY_MODEL_NAME}",
+    )
+    parser.add_argument("--conf", default="model_confs.yaml")
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file for the JSON report")
+    parser.add_argument("--baseline", help="JSON report to compare with")
+    args = parser.parse_args()
+
+    if args.model == TINY_MODEL_NAME:
+        model_confs = tiny_model_confs()
+    else:
+        model_confs = ModelConfigurations(args.conf)
+
+    chat_bot = ChatBot(args.model, model_confs)
+    chat_bot.initialize()
+
+    torch.manual_seed(args.seed)
+    turns = run_conversation(chat_bot, args.turns)
+    report = {
+        "model": args.model,
+        "repo": model_confs.repo(args.model),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "platform": platform.platform(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+        "num_threads": torch.get_num_threads(),
+        "summary": summarize(turns),
+        "turns": turns,
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            compare(report["summary"], json.load(f)["summary"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+"""This module defines the name of the chat bot. It has no dependencies, so
+the flet application can show it without importing the model libraries."""
+
+BOT_NAME = "Leonia Bot"
@@ -0,0 +1,69 @@
+"""This module defines the `CachedModel` class, which runs a causal language
+model, through its inference backend, keeping the keys and values of the
+tokens it has already seen."""
+
+from typing import List
+
+import torch
+
+
+def crop_cache(past_key_values, length: int):
+    """This function crops the cached keys and values so that they only cover
+    the first `length` tokens."""
+    return tuple(
+        (key[:, :, :length, :], value[:, :, :length, :])
+        for key, value in past_key_values
+    )
+
+
+class CachedModel:
+    """This class runs a model over a sequence of tokens that grows at the
+    end, and may be cut back, reusing the cached keys and values of the tokens
+    already seen, so each token is only run through the model once."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.past_key_values = None
+        # The tokens covered by the cached keys and values
+        self.cache_ids: List[int] = []
+        # The tokens of the last prefill whose keys and values were reused
+        self.num_reused = 0
+
+    def set_cache(self, past_key_values, ids: List[int]) -> None:
+        """This function replaces the cache with the given keys and values,
+        which must be those of the given tokens."""
+        self.past_key_values = past_key_values
+        self.cache_ids = list(ids)
+
+    def crop(self, length: int) -> None:
+        """This function drops the cached keys and values of the tokens after
+        the first `length`."""
+        if length == 0:
+            self.past_key_values = None
+        elif length < len(self.cache_ids):
+            self.past_key_values = crop_cache(self.past_key_values, length)
+        self.cache_ids = self.cache_ids[:length]
+
+    def forward(self, ids: List[int]) -> torch.Tensor:
+        """This function runs the model over the given tokens, which must follow
+        the ones already in the cache, and returns the logits for each one."""
+        logits, self.past_key_values = self.backend.forward(
+            torch.tensor([ids]), self.past_key_values
+        )
+        self.cache_ids.extend(ids)
+
+        return logits[0]
+
+    def prefill(self, ids: List[int]) -> torch.Tensor:
+        """This function makes the cache cover the given tokens, reusing the
+        longest prefix already cached, and returns the logits for the last
+        token."""
+        common = 0
+        max_common = min(len(ids), len(self.cache_ids)) - 1
+        while common < max_common and ids[common] == self.cache_ids[common]:
+            common += 1
+
+        self.crop(common)
+        self.num_reused = common
+
+        return self.forward(ids[common:])[-1]
@@ -1,15 +1,49 @@
 """This module contains the `ChatBot` class, which is used to interact with the
 chat bot."""
 
-from typing import Iterator
+from bisect import bisect_left
+import copy
+import os
+from queue import Queue
+import sys
+from threading import Event, Thread
+import time
+from typing import Iterator, List, Optional
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+import torch
 from transformers import (
     AutoTokenizer,
-    AutoModelForCausalLM,
+    LogitsProcessorList,
+    MaxLengthCriteria,
+    StoppingCriteriaList,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
 )
 
+from batch_scheduler import BatchScheduler
+from bot_name import BOT_NAME
+from cached_model import CachedModel
+from context_window import ContextWindow
+from generation_metrics import GenerationMetrics
+from inference_backend import BACKENDS, InferenceBackend, load_backend
+from incremental_decoder import IncrementalDecoder
 from model_configurations import ModelConfigurations
+from model_index import ModelIndex, model_revision
+from prefix_cache import load_or_compute_prefix, prefix_key
+from stopping_criteria import (
+    StopOnEvent,
+    cut_at_markers,
+    has_new_marker,
+    held_back_length,
+)
 
-BOT_NAME = "Leonia Bot"
+DEFAULT_MAX_NEW_TOKENS = 256
 
 
 INITIAL_PROMPT = f"""The following is a conversation between a human and bot, a very intelligent assistant based on a LLM. The bot, named {BOT_NAME}, tries to be helpful and tries to help the user answering his questions. The conversation begins:
@@ -35,6 +69,86 @@ class ChatBotConf:
         self.token_end = params["token_end"]
         self.token_human = params["token_human"]
         self.token_bot = params["token_bot"]
+        # Whether the model can run padded batches of conversations
+        self.padding = params["padding"]
+        self.max_new_tokens = params.get("max_new_tokens", DEFAULT_MAX_NEW_TOKENS)
+        # If not given, the maximum context of the model is used
+        self.max_context_tokens = params.get("max_context_tokens")
+
+        # Options for loading the model. Loading in a smaller data type, such
+        # as bfloat16, with low_cpu_mem_usage avoids keeping a full extra copy
+        # of the weights in memory while they are read, and safetensors files
+        # are memory-mapped.
+        self.torch_dtype = params.get("torch_dtype")
+        self.low_cpu_mem_usage = params.get("low_cpu_mem_usage", False)
+        self.use_safetensors = params.get("use_safetensors")
+        # One of `quantization.QUANTIZATIONS`, or None for full precision
+        self.quantization = params.get("quantization")
+        # The engine that runs the model, one of `inference_backend.BACKENDS`
+        self.backend = params.get("backend", "pytorch")
+        if self.backend not in BACKENDS:
+            raise ValueError(
+                f"Invalid backend: {self.backend}. Valid values: {BACKENDS}"
+            )
+        # A small model with the same tokenizer that proposes tokens for the
+        # model to check, and how many it proposes each step
+        self.draft_repo = params.get("draft_repo")
+        self.num_draft_tokens = params.get("num_draft_tokens", 4)
+
+        # Markers that end the answer: the end token and the beginning of a new
+        # turn, which happens when the model starts writing for the human
+        self.stop_markers = [self.token_end, self.token_human, self.token_bot]
+
+    def load_kwargs(self) -> dict:
+        """This function returns the keyword arguments for `from_pretrained`."""
+        kwargs = {"low_cpu_mem_usage": self.low_cpu_mem_usage}
+        if self.quantization is not None:
+            # Models are quantized from their float32 weights
+            kwargs["torch_dtype"] = torch.float32
+        elif self.torch_dtype is not None:
+            kwargs["torch_dtype"] = getattr(torch, self.torch_dtype)
+        if self.use_safetensors is not None:
+            kwargs["use_safetensors"] = self.use_safetensors
+
+        return kwargs
+
+
+_END_OF_ANSWER = object()
+
+
+class DraftStats:
+    """This class counts the tokens proposed by the draft model and those
+    accepted by the model, to judge whether the draft pays off."""
+
+    def __init__(self):
+        self.proposed = 0
+        self.accepted = 0
+
+    def add(self, proposed: int, accepted: int) -> None:
+        """This function adds the tokens of one step."""
+        self.proposed += proposed
+        self.accepted += accepted
+
+    def acceptance_rate(self) -> float:
+        """This function returns the fraction of proposed tokens accepted."""
+        return self.accepted / self.proposed if self.proposed else 0.0
+
+    def __str__(self) -> str:
+        return f"{self.acceptance_rate():.0%} ({self.accepted}/{self.proposed})"
+
+
+def peak_rss_gb() -> Optional[float]:
+    """Return the peak resident memory of the process in GB, or None if it
+    cannot be measured on this platform."""
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # It is given in bytes on macOS and in kilobytes elsewhere
+    if sys.platform != "darwin":
+        peak *= 1024
+
+    return peak / 1024**3
 
 
 class ChatBot:
@@ -47,9 +161,18 @@ class ChatBot:
         the directory containing the model files."""
         self.model_name = model_name
         self.model_confs = model_confs
-        self.model = None
+        self.backend: Optional[InferenceBackend] = None
         self.tokenizer = None
-        self.prev_prompt = None
+        self.logits_warper = None
+        self.context = None
+        self.system_ids = None
+        self.system_past_key_values = None
+        self.cached_model = None
+        self.draft_model = None
+        self.draft_stats = DraftStats()
+        self.scheduler = None
+        # The metrics of the last answer
+        self.last_metrics: Optional[GenerationMetrics] = None
         self.conf = ChatBotConf(model_name, model_confs)
 
     def initialize(self):
@@ -59,56 +182,325 @@ class ChatBot:
         if not self.model_confs.is_valid_name(self.model_name):
             raise ValueError(f"Invalid model name: {self.model_name}")
 
+        start = time.time()
         repo = self.model_confs.repo(self.model_name)
-        self.model = AutoModelForCausalLM.from_pretrained(repo)
+        self.backend = load_backend(
+            self.conf.backend, repo, self.conf, self.conf.quantization
+        )
+        self.cached_model = CachedModel(self.backend)
         self.tokenizer = AutoTokenizer.from_pretrained(repo)
 
-        self.prev_prompt = INITIAL_PROMPT
+        if self.conf.draft_repo is not None:
+            print(f"Loading draft model {self.conf.draft_repo}...")
+            self.draft_model = CachedModel(
+                load_backend(self.conf.backend, self.conf.draft_repo, self.conf)
+            )
 
-    def next_tokens(self, prompt: str) -> str:
-        """Get the next tokens for the given prompt."""
         params = self.model_confs.params(self.model_name)
-        input_ids = self.tokenizer.encode(
-            prompt,
-            return_tensors="pt",
-            padding=params["padding"],
-        )
-        output = self.model.generate(
-            input_ids,
-            max_length=len(input_ids[0]) + 20,
-            do_sample=True,
-            top_k=params["top_k"],
-            top_p=params["top_p"],
-            early_stopping=True,
-            pad_token_id=self.tokenizer.eos_token_id,
+        self.logits_warper = LogitsProcessorList(
+            [TopKLogitsWarper(params["top_k"]), TopPLogitsWarper(params["top_p"])]
         )
-        answer = self.tokenizer.decode(
-            output[0], truncate_before_pattern=[r"\n\n^#", "^'''", "\n\n\n"]
+
+        # The keys and values of the system prompt are computed only once per
+        # model, version of its files, backend, prompt and data type, and then
+        # read back from disk
+        self.system_ids = self.tokenizer.encode(INITIAL_PROMPT)
+        model_id = repo
+        if self.conf.quantization is not None:
+            model_id += f" ({self.conf.quantization})"
+        if self.conf.backend != "pytorch":
+            model_id += f" ({self.conf.backend})"
+        self.system_past_key_values = load_or_compute_prefix(
+            prefix_key(
+                model_id, model_revision(repo), INITIAL_PROMPT, self.backend.dtype
+            ),
+            self._compute_prefix,
         )
 
-        # Get everything after the prompt
-        new_info = answer[len(prompt) - 3 :]
+        self.reset()
+
+        # Record what has been downloaded, so the application does not have to
+        # scan the whole cache to find it
+        model_index = ModelIndex()
+        for downloaded_repo in (repo, self.conf.draft_repo):
+            if downloaded_repo is not None and not os.path.isdir(downloaded_repo):
+                model_index.refresh_repo(downloaded_repo)
+
+        report = f"Loaded {repo} in {time.time() - start:.1f} sec"
+        peak_rss = peak_rss_gb()
+        if peak_rss is not None:
+            report += f" (peak memory {peak_rss:.1f} GB)"
+        print(report)
+
+    def _compute_prefix(self):
+        """Run the model over the system prompt and return its keys and
+        values."""
+        self.cached_model.crop(0)
+        self.cached_model.forward(self.system_ids)
+
+        return self.cached_model.past_key_values
+
+    def enable_batching(self) -> None:
+        """Run the decoding steps of this chat bot and its forks in batches, if
+        the model configuration allows padding. Answers generated with a
+        draft model are not batched."""
+        if self.scheduler is None and self.conf.padding:
+            self.scheduler = BatchScheduler(self.backend)
 
-        return new_info
+    def fork(self) -> "ChatBot":
+        """Return a chat bot that shares the model and tokenizer with this one,
+        but has its own conversation, so several conversations can be held
+        without loading the model again. Forks made after `enable_batching`
+        share the batches."""
+        chat_bot = copy.copy(self)
+        chat_bot.cached_model = CachedModel(self.backend)
+        if self.draft_model is not None:
+            chat_bot.draft_model = CachedModel(self.draft_model.backend)
+        chat_bot.draft_stats = DraftStats()
+        chat_bot.reset()
 
-    def get_answer(self, user_msg: str) -> Iterator[str]:
-        """Get the answer for the given user message."""
-        prompt = (
-            self.prev_prompt + self.conf.token_human + user_msg + self.conf.token_bot
+        return chat_bot
+
+    def reset(self):
+        """Start a new conversation. This drops the cached keys and values of
+        the previous one, keeping only those of the system prompt."""
+        max_tokens = (
+            self.conf.max_context_tokens or self.backend.max_position_embeddings
+        )
+        self.context = ContextWindow(
+            self.system_ids, max_tokens, self.conf.max_new_tokens
         )
-        next_tokens = self.next_tokens(prompt)
-        new_info = next_tokens
+        self.cached_model.set_cache(self.system_past_key_values, self.system_ids)
+
+    def _sample(self, logits: torch.Tensor) -> int:
+        """Choose the next token from the logits of the last one."""
+        params = self.model_confs.params(self.model_name)
+        if not params["do_sample"]:
+            return int(torch.argmax(logits))
+
+        scores = self.logits_warper(None, logits.unsqueeze(0))
+        probs = torch.softmax(scores, dim=-1)
+        return int(torch.multinomial(probs, num_samples=1)[0])
+
+    def _tokens(self, prompt_ids: List[int]) -> Iterator[int]:
+        """Generate the tokens that follow the prompt, one model step each. The
+        generator is suspended after yielding a token, so no step is run once
+        the caller stops."""
+        logits = self.cached_model.prefill(prompt_ids)
+        if self.scheduler is None:
+            while True:
+                token = self._sample(logits)
+                yield token
+                logits = self.cached_model.forward([token])[-1]
+
+        try:
+            while True:
+                token = self._sample(logits)
+                yield token
+                logits = self.scheduler.decode(self.cached_model, token)
+        finally:
+            self.scheduler.release(self.cached_model)
 
+    def _assisted_tokens(
+        self, prompt_ids: List[int], stats: DraftStats
+    ) -> Iterator[int]:
+        """Generate the tokens that follow the prompt with the help of the
+        draft model. The draft proposes the next few tokens and the model
+        checks all of them in a single step. Each token is still chosen by the
+        model from its own distribution, so the answer is the same as without
+        the draft, but several tokens may be accepted per step."""
+        token = self._sample(self.cached_model.prefill(prompt_ids))
         while True:
-            if self.conf.token_end in new_info:
-                yield next_tokens.split(self.conf.token_end)[0]
-                break
+            yield token
+
+            # The draft proposes the next tokens greedily
+            draft_logits = self.draft_model.prefill(
+                self.cached_model.cache_ids + [token]
+            )
+            proposal = []
+            for _ in range(self.conf.num_draft_tokens):
+                proposal.append(int(torch.argmax(draft_logits)))
+                if len(proposal) < self.conf.num_draft_tokens:
+                    draft_logits = self.draft_model.forward(proposal[-1:])[-1]
+
+            # The model checks them in a single step, accepting them while
+            # they match its own choices
+            logits = self.cached_model.forward([token] + proposal)
+            accepted = 0
+            for draft_token in proposal:
+                token = self._sample(logits[accepted])
+                if token != draft_token:
+                    break
+                accepted += 1
+                yield token
+            else:
+                token = self._sample(logits[accepted])
+
+            stats.add(len(proposal), accepted)
+            # Drop the keys and values of the rejected tokens
+            self.cached_model.crop(
+                len(self.cached_model.cache_ids) - (len(proposal) - accepted)
+            )
+
+    def _answer_ids(self, new_ids: List[int], offsets: List[int], answer: str):
+        """Return the tokens of the answer that is kept in the conversation,
+        i.e., the generated tokens without the marker that ended it. `offsets`
+        holds the length of the decoded text after each token. If no prefix of
+        the tokens decodes exactly to the answer, it is tokenized again."""
+        if not answer:
+            return []
+
+        length = bisect_left(offsets, len(answer))
+        if length < len(offsets) and offsets[length] == len(answer):
+            return new_ids[: length + 1]
+
+        return self.tokenizer.encode(answer, add_special_tokens=False)
+
+    def _generate(
+        self,
+        prompt_ids: List[int],
+        fragments: Queue,
+        cancel: Event,
+        metrics: GenerationMetrics,
+        start: float,
+    ) -> None:
+        """Generate the answer for the given prompt in a single decoding loop,
+        putting each new fragment of text in the queue as soon as its token is
+        produced. The loop stops within one step once `cancel` is set. The
+        metrics of the answer are filled in, taking `start`, from
+        `time.perf_counter`, as the time of the message. This runs in a worker
+        thread started by `get_answer`."""
+        try:
+            metrics.prompt_tokens = len(prompt_ids)
+            prefill_start = time.perf_counter()
+            answer_stats = DraftStats()
+            if self.draft_model is None:
+                tokens = self._tokens(prompt_ids)
+            else:
+                tokens = self._assisted_tokens(prompt_ids, answer_stats)
 
-            yield next_tokens
+            stopping_criteria = StoppingCriteriaList(
+                [
+                    MaxLengthCriteria(self.conf.max_new_tokens),
+                    StopOnEvent(cancel),
+                ]
+            )
+
+            # The generated tokens are written in place, so the stopping
+            # criteria get a view of them without copying the answer each step
+            new_ids = torch.zeros((1, self.conf.max_new_tokens), dtype=torch.long)
+            num_new = 0
+            decoder = IncrementalDecoder(self.tokenizer)
+            text = ""
+            offsets = []
+            sent = 0
+            cancelled = False
+            first_token_time = last_token_time = None
+            for token in tokens:
+                last_token_time = time.perf_counter()
+                if first_token_time is None:
+                    # The first token comes right after the prefill
+                    first_token_time = last_token_time
+                    metrics.prefill_sec = first_token_time - prefill_start
+                    metrics.time_to_first_token_sec = first_token_time - start
+                    metrics.cached_tokens = self.cached_model.num_reused
+
+                new_ids[0, num_new] = token
+                num_new += 1
+                fragment = decoder.push(token)
+                text += fragment
+                offsets.append(len(text))
+
+                cancelled = cancel.is_set()
+                ended = (
+                    cancelled
+                    or token == self.tokenizer.eos_token_id
+                    or has_new_marker(text, self.conf.stop_markers, len(fragment))
+                    or bool(stopping_criteria(new_ids[:, :num_new], None))
+                )
+                if cancelled:
+                    # Keep only the part of the answer that has been shown
+                    text = text[:sent]
+                    ready = sent
+                elif ended:
+                    text = cut_at_markers(text, self.conf.stop_markers)
+                    ready = len(text)
+                else:
+                    ready = len(text) - held_back_length(
+                        text, self.conf.stop_markers
+                    )
+
+                if ready > sent:
+                    fragments.put(text[sent:ready])
+                    sent = ready
+
+                # No decoding step is run once the answer is complete
+                if ended:
+                    break
+            tokens.close()
+
+            metrics.generated_tokens = num_new
+            if first_token_time is not None:
+                metrics.decode_sec = last_token_time - first_token_time
+            metrics.draft_proposed_tokens = answer_stats.proposed
+            metrics.draft_accepted_tokens = answer_stats.accepted
+            metrics.cancelled = cancelled
+            self.last_metrics = metrics
+
+            self.draft_stats.add(answer_stats.proposed, answer_stats.accepted)
+            if self.draft_model is not None:
+                print(
+                    f"Draft acceptance rate: {answer_stats} in this answer,"
+                    f" {self.draft_stats} in total"
+                )
+
+            # Update the conversation
+            self.context.end_turn(
+                self._answer_ids(new_ids[0, :num_new].tolist(), offsets, text)
+            )
+            fragments.put(_END_OF_ANSWER)
+        except Exception as error:  # pylint: disable=broad-except
+            fragments.put(error)
+
+    def get_answer(
+        self, user_msg: str, cancel: Optional[Event] = None
+    ) -> Iterator[str]:
+        """Get the answer for the given user message. The answer is generated
+        in a background thread and the fragments of text are yielded as soon as
+        they are available. Setting `cancel`, which must be a new event for
+        each answer, stops the generation and keeps the part of the answer
+        yielded so far in the conversation. The metrics of the answer are
+        left in `last_metrics` once the fragments have been consumed."""
+        start = time.perf_counter()
+        turn_ids = self.tokenizer.encode(
+            self.conf.token_human + user_msg + self.conf.token_bot,
+            add_special_tokens=False,
+        )
+        prompt_ids = self.context.begin_turn(turn_ids)
+
+        if cancel is None:
+            cancel = Event()
+
+        fragments = Queue()
+        metrics = GenerationMetrics(self.model_name)
+        thread = Thread(
+            target=self._generate,
+            args=(prompt_ids, fragments, cancel, metrics, start),
+            daemon=True,
+        )
+        thread.start()
 
-            prompt = prompt + next_tokens
-            next_tokens = self.next_tokens(prompt)
-            new_info += next_tokens
+        try:
+            while True:
+                fragment = fragments.get()
+                if fragment is _END_OF_ANSWER:
+                    break
+                if isinstance(fragment, Exception):
+                    raise fragment
 
-        # Update the prompt
-        self.prev_prompt = prompt + new_info.split(self.conf.token_end)[0]
+                yield fragment
+        finally:
+            # If the caller stops early, the answer is cancelled and committed
+            # before returning, so the conversation is consistent afterwards
+            cancel.set()
+            thread.join()
@@ -0,0 +1,106 @@
+"""This module defines the `ChatServerClient` class, which talks to the chat
+server in `chat_server.py`. It has the same interface as `InferenceWorker`,
+so the flet application can use a shared server instead of its own worker."""
+
+import http.client
+import json
+from typing import Iterator, Optional, TextIO
+from urllib.parse import urlsplit
+
+from generation_metrics import GenerationMetrics
+
+
+class ChatServerClient:
+    """This class holds a session of the chat server."""
+
+    def __init__(self, url: str):
+        """Initialize the client for the server at the given URL, e.g.,
+        http://127.0.0.1:8734."""
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.session_id: Optional[str] = None
+        # The metrics of the last answer
+        self.last_metrics: Optional[GenerationMetrics] = None
+
+    def _request(self, method: str, path: str, body: Optional[dict] = None):
+        """This function sends a request and returns the response. Each request
+        uses its own connection, so a request can be sent while an answer is
+        being streamed."""
+        conn = http.client.HTTPConnection(self.host, self.port)
+        headers = {}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        conn.request(method, path, body=data, headers=headers)
+        response = conn.getresponse()
+        if response.status >= 400:
+            raise RuntimeError(
+                f"Error in the chat server: {response.read().decode('utf-8')}"
+            )
+
+        return response
+
+    def _json(self, method: str, path: str, body: Optional[dict] = None) -> dict:
+        return json.loads(self._request(method, path, body).read())
+
+    def load_model(self, model_name: str, log: TextIO) -> str:
+        """Start a conversation with the given model, ending the previous one.
+        The model is loaded by the server if needed. A line describing the
+        session is written to `log` and returned."""
+        self.close()
+        self.session_id = self._json("POST", "/sessions", {"model": model_name})[
+            "session"
+        ]
+
+        report = f"Chatting with {model_name} on {self.host}:{self.port}"
+        log.write(report)
+
+        return report
+
+    def get_answer(self, user_msg: str) -> Iterator[str]:
+        """Get the answer for the given user message as a stream of fragments
+        of text. If the caller stops early, the answer is cancelled. The
+        metrics of the answer are left in `last_metrics` at the end."""
+        self.last_metrics = None
+        response = self._request(
+            "POST", f"/sessions/{self.session_id}/messages", {"message": user_msg}
+        )
+        try:
+            for line in response:
+                reply = json.loads(line)
+                if "error" in reply:
+                    raise RuntimeError(f"Error in the chat server: {reply['error']}")
+                if reply.get("end"):
+                    if reply.get("metrics") is not None:
+                        self.last_metrics = GenerationMetrics.from_dict(
+                            reply["metrics"]
+                        )
+                    break
+
+                yield reply["fragment"]
+        except GeneratorExit:
+            self.cancel()
+            raise
+        finally:
+            response.close()
+
+    def preload(self, model_name: str) -> None:
+        """Ask the server to load the given model in the background."""
+        self._json("POST", f"/models/{model_name}/preload")
+
+    def clear(self) -> None:
+        """Start a new conversation. An answer in progress is cancelled."""
+        self._json("POST", f"/sessions/{self.session_id}/clear")
+
+    def cancel(self) -> None:
+        """Stop the answer in progress, if any. The part of the answer already
+        received is kept in the conversation."""
+        self._json("POST", f"/sessions/{self.session_id}/cancel")
+
+    def close(self) -> None:
+        """End the session, if any."""
+        if self.session_id is not None:
+            self._json("DELETE", f"/sessions/{self.session_id}")
+            self.session_id = None
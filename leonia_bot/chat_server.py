@@ -0,0 +1,312 @@
+"""This is a headless chat server. It loads each configured model once and
+holds any number of conversations (sessions) with them, so several users can
+chat at the same time without loading the model once per user. The decoding
+steps of the sessions with the same model are run in batches. Answers are
+streamed over HTTP as newline-delimited JSON.
+
+The API is:
+
+- `GET /models`: the model configurations and which of them are loaded.
+- `GET /metrics`: the metrics of the last answers (tokens, time to first token,
+  prefill time, decoding speed and cache hits) and their means.
+- `POST /models/<model>/preload`: start loading a model in the background, if
+  it is already downloaded.
+- `POST /sessions` with `{"model": <model>}`: start a conversation. The reply
+  is `{"session": <session>}`. The models of the sessions are never unloaded,
+  so if the model does not fit in memory with them, the status is 503. Other
+  errors, e.g., when the model cannot be loaded, have the status 500.
+- `POST /sessions/<session>/messages` with `{"message": <text>}`: send a
+  message. The reply is a stream of `{"fragment": <text>}` lines, ended by
+  `{"end": true, "metrics": <metrics>}` or `{"error": <text>}`.
+- `POST /sessions/<session>/cancel`: stop the answer in progress.
+- `POST /sessions/<session>/clear`: start the conversation again.
+- `DELETE /sessions/<session>`: end the conversation.
+
+Run it from the root of the repository with:
+
+    python leonia_bot/chat_server.py --port 8734
+"""
+
+import argparse
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+from threading import Event, Lock
+import time
+from typing import Iterator
+import uuid
+
+from generation_metrics import MetricsLog
+from model_cache import ModelCache, ModelDoesNotFit
+from model_configurations import ModelConfigurations
+
+# Sessions not used for this long are ended
+SESSION_TIMEOUT_SEC = 60 * 60
+
+
+class _Session:
+    """This class holds the conversation of a session."""
+
+    def __init__(self, model_name: str, chat_bot):
+        self.model_name = model_name
+        self.chat_bot = chat_bot
+        # Messages of a session are answered one at a time
+        self.lock = Lock()
+        self.cancel = Event()
+        self.last_used = time.time()
+
+
+class ChatServer:
+    """This class keeps the sessions and the models they share."""
+
+    def __init__(self, model_confs: ModelConfigurations):
+        self.model_confs = model_confs
+        self.models = ModelCache(model_confs)
+        self.sessions = {}
+        self.sessions_lock = Lock()
+        self.metrics = MetricsLog.from_env()
+
+    def create_session(self, model_name: str) -> str:
+        """This function starts a conversation with the given model, loading
+        it if needed, and returns the id of the session."""
+        if not self.model_confs.is_valid_name(model_name):
+            raise ValueError(f"Invalid model name: {model_name}")
+
+        # Expired sessions no longer keep their models from being evicted
+        with self.sessions_lock:
+            self._expire_sessions()
+
+        # The model is pinned until the session ends, as evicting it while the
+        # session uses it would free no memory
+        template = self.models.get(model_name, pin=True)
+        session_id = uuid.uuid4().hex
+        with self.sessions_lock:
+            # The decoding steps of the sessions with the model are batched
+            template.enable_batching()
+            chat_bot = template.fork()
+            self.sessions[session_id] = _Session(model_name, chat_bot)
+
+        return session_id
+
+    def _expire_sessions(self) -> None:
+        now = time.time()
+        for session_id, session in list(self.sessions.items()):
+            if now - session.last_used > SESSION_TIMEOUT_SEC:
+                self._end_session(session_id)
+
+    def _end_session(self, session_id: str) -> None:
+        session = self.sessions.pop(session_id)
+        session.cancel.set()
+        self.models.unpin(session.model_name)
+
+    def session(self, session_id: str) -> _Session:
+        """This function returns the session with the given id. It raises
+        KeyError if there is none."""
+        with self.sessions_lock:
+            session = self.sessions[session_id]
+        session.last_used = time.time()
+
+        return session
+
+    def delete_session(self, session_id: str) -> None:
+        """This function ends the given session."""
+        with self.sessions_lock:
+            self._end_session(session_id)
+
+    def get_answer(self, session_id: str, user_msg: str) -> Iterator[str]:
+        """This function returns the fragments of the answer to the message.
+        A message sent while another is being answered cancels it. It raises
+        KeyError if there is no such session."""
+        return self._answer(self.session(session_id), user_msg)
+
+    def _answer(self, session: _Session, user_msg: str) -> Iterator[str]:
+        session.cancel.set()
+        with session.lock:
+            session.cancel = Event()
+            try:
+                yield from session.chat_bot.get_answer(user_msg, session.cancel)
+            finally:
+                # The metrics are ready once the answer is over, even if it
+                # was cancelled
+                if session.chat_bot.last_metrics is not None:
+                    self.metrics.add(session.chat_bot.last_metrics)
+
+    def clear(self, session_id: str) -> None:
+        """This function starts the conversation of the session again."""
+        session = self.session(session_id)
+        session.cancel.set()
+        with session.lock:
+            session.chat_bot.reset()
+
+    def model_list(self) -> dict:
+        """This function returns the configurations of the models and whether
+        they are loaded."""
+        return {
+            model_name: {**params, "loaded": model_name in self.models.chat_bots}
+            for model_name, params in self.model_confs.confs.items()
+        }
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """This class handles the requests of the API of the chat server."""
+
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def chat(self) -> ChatServer:
+        """The chat server that handles the requests."""
+        return self.server.chat
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length", 0))
+        if length == 0:
+            return {}
+
+        return json.loads(self.rfile.read(length))
+
+    def _read_field(self, name: str) -> str:
+        """This function returns the given string field of the JSON body. It
+        raises ValueError if the body is not an object with that field."""
+        body = self._read_json()
+        if not isinstance(body, dict) or not isinstance(body.get(name), str):
+            raise ValueError(f'The body must be a JSON object with a "{name}" string')
+
+        return body[name]
+
+    def _send_json(self, obj, status: HTTPStatus = HTTPStatus.OK) -> None:
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_chunk(self, obj) -> None:
+        data = (json.dumps(obj) + "\n").encode("utf-8")
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _stream_answer(self, session_id: str, user_msg: str) -> None:
+        session = self.chat.session(session_id)
+        fragments = self.chat.get_answer(session_id, user_msg)
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        try:
+            try:
+                for fragment in fragments:
+                    self._send_chunk({"fragment": fragment})
+                metrics = session.chat_bot.last_metrics
+                self._send_chunk(
+                    {"end": True, "metrics": metrics and metrics.to_dict()}
+                )
+            except (BrokenPipeError, ConnectionResetError):
+                raise
+            except Exception as error:  # pylint: disable=broad-except
+                self._send_chunk({"error": repr(error)})
+
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client is gone, e.g., because it stopped reading the answer.
+            # Closing the fragments cancels the answer.
+            fragments.close()
+            self.close_connection = True
+
+    def _handle(self, method: str) -> None:
+        path = self.path.rstrip("/")
+        try:
+            if method == "GET" and path == "/models":
+                self._send_json(self.chat.model_list())
+            elif method == "GET" and path == "/metrics":
+                self._send_json(self.chat.metrics.to_dict())
+            elif method == "POST" and (
+                match := re.fullmatch(r"/models/([^/]+)/preload", path)
+            ):
+                if not self.chat.model_confs.is_valid_name(match.group(1)):
+                    raise ValueError(f"Invalid model name: {match.group(1)}")
+                self.chat.models.preload(match.group(1))
+                self._send_json({})
+            elif method == "POST" and path == "/sessions":
+                session_id = self.chat.create_session(self._read_field("model"))
+                self._send_json({"session": session_id}, HTTPStatus.CREATED)
+            elif method == "POST" and (
+                match := re.fullmatch(r"/sessions/(\w+)/(messages|cancel|clear)", path)
+            ):
+                session_id, action = match.groups()
+                if action == "messages":
+                    self._stream_answer(session_id, self._read_field("message"))
+                elif action == "cancel":
+                    self.chat.session(session_id).cancel.set()
+                    self._send_json({})
+                else:
+                    self.chat.clear(session_id)
+                    self._send_json({})
+            elif method == "DELETE" and (
+                match := re.fullmatch(r"/sessions/(\w+)", path)
+            ):
+                self.chat.delete_session(match.group(1))
+                self._send_json({})
+            else:
+                self._send_json({"error": "Not found"}, HTTPStatus.NOT_FOUND)
+        except KeyError as error:
+            self._send_json({"error": f"Not found: {error}"}, HTTPStatus.NOT_FOUND)
+        except (ValueError, TypeError) as error:
+            self._send_json({"error": str(error)}, HTTPStatus.BAD_REQUEST)
+        except ModelDoesNotFit as error:
+            # The model does not fit in memory with those of the sessions
+            self._send_json({"error": str(error)}, HTTPStatus.SERVICE_UNAVAILABLE)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away
+            pass
+        except Exception as error:  # pylint: disable=broad-except
+            # E.g., the model could not be loaded
+            self._send_json({"error": str(error)}, HTTPStatus.INTERNAL_SERVER_ERROR)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """This function handles GET requests."""
+        self._handle("GET")
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """This function handles POST requests."""
+        self._handle("POST")
+
+    def do_DELETE(self):  # pylint: disable=invalid-name
+        """This function handles DELETE requests."""
+        self._handle("DELETE")
+
+
+def serve(host: str, port: int, conf_file_name: str, preload=()) -> None:
+    """This function runs the chat server until it is interrupted."""
+    http_server = ThreadingHTTPServer((host, port), _RequestHandler)
+    http_server.daemon_threads = True
+    http_server.chat = ChatServer(ModelConfigurations(conf_file_name))
+    for model_name in preload:
+        http_server.chat.models.get(model_name)
+
+    print(f"Serving on http://{host}:{port}")
+    http_server.serve_forever()
+
+
+def main():
+    """This function parses the command line and runs the chat server."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8734)
+    parser.add_argument("--conf", default="model_confs.yaml")
+    parser.add_argument(
+        "--preload",
+        nargs="*",
+        default=[],
+        help="models to load before accepting requests",
+    )
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.conf, args.preload)
+
+
+if __name__ == "__main__":
+    main()
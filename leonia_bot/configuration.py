@@ -1,12 +1,14 @@
 """This file defines a configuration control that allows selecting models and
 their configuration for the chat bot."""
 
+import os
+import shutil
 from typing import List
 
-from huggingface_hub import scan_cache_dir
 import flet as ft
 
-from model_configurations import ModelConfigurations
+from model_configurations import GB, ModelConfigurations, required_bytes
+from model_index import ModelIndex
 
 
 def get_init_config(page: ft.Page) -> str:
@@ -18,6 +20,53 @@ def get_init_config(page: ft.Page) -> str:
     return page.client_storage.get("model")
 
 
+def _free_disk_bytes(path: str) -> int:
+    """This function returns the free space of the disk that holds the given
+    path, which may not exist yet, or relative."""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            # Not even the root exists, e.g., a drive that is not mounted
+            return 0
+        path = parent
+
+    return shutil.disk_usage(path).free
+
+
+def requirement_warnings(params: dict, model_index: ModelIndex) -> List[str]:
+    """This function returns warnings for the requirements of a model that this
+    computer does not meet, according to the `requirements` field of its
+    configuration. The space needed on disk does not count the part of the
+    model already downloaded."""
+    warnings = []
+
+    needed_ram = required_bytes(params, "RAM")
+    try:
+        ram = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        # Not available on this platform
+        ram = None
+    if ram is not None and needed_ram > ram:
+        warnings.append(
+            f"Warning: this model needs {needed_ram / GB:.0f} GB of RAM, but"
+            f" this computer has {ram / GB:.0f} GB."
+        )
+
+    needed_disk = required_bytes(params, "disk") - model_index.downloaded_bytes(
+        params["repo"]
+    )
+    if needed_disk > 0:
+        free_disk = _free_disk_bytes(model_index.cache_dir)
+        if needed_disk > free_disk:
+            warnings.append(
+                f"Warning: downloading this model needs {needed_disk / GB:.0f} GB"
+                f" of disk, but only {free_disk / GB:.0f} GB are free."
+            )
+
+    return warnings
+
+
 class ConfigurationControl(ft.UserControl):
     """This class implements a configuration control, which is used to
     configure the chat bot."""
@@ -26,18 +75,29 @@ class ConfigurationControl(ft.UserControl):
         super().__init__()
         self.page = page
         self.model_confs = model_confs
+        # The index is read from disk, and refreshed once the control is shown
+        self.model_index = ModelIndex()
         self.dd_model = None
         self.text_model_info = None
         self.button_apply = None
         self.conf_change_hook = None
+        self.model_selected_hook = None
 
     def __dropdown_changed(self, event):
         """This function is called when the user selects a model from the
         dropdown."""
         model_name = self.dd_model.value
-        self.text_model_info.value = self.model_confs.params_to_str(model_name)
+        self.text_model_info.value = self.__model_info(model_name)
         self.text_model_info.update()
 
+        # Only downloaded models are preloaded, as merely selecting a model
+        # must not start a download
+        repo = self.model_confs.repo(model_name)
+        if self.model_selected_hook is not None and self.model_index.is_downloaded(
+            repo
+        ):
+            self.model_selected_hook(model_name)
+
     def __on_apply(self, event):
         """This function is called when the user clicks the Apply button. It
         saves the configuration to the client storage."""
@@ -46,14 +106,20 @@ class ConfigurationControl(ft.UserControl):
 
         self.conf_change_hook(model_name)
 
+    def __model_info(self, model_name: str) -> str:
+        """This function returns the description of a model, with warnings for
+        the requirements that are not met."""
+        params = self.model_confs.params(model_name)
+        warnings = requirement_warnings(params, self.model_index)
+
+        return "\n".join(warnings + [self.model_confs.params_to_str(model_name)])
+
     def __create_model_name_options(self) -> List[ft.dropdown.Option]:
         """This function creates the options for the model dropdown."""
-        cached_repos = scan_cache_dir().repos
-        cached_repo_names = [repo.repo_id for repo in cached_repos]
         options = []
         for model_name, info in self.model_confs.confs.items():
             model_repo = info["repo"]
-            if model_repo in cached_repo_names:
+            if self.model_index.is_downloaded(model_repo):
                 option = model_repo
             else:
                 option = f"{model_repo} (not downloaded)"
@@ -82,10 +148,33 @@ class ConfigurationControl(ft.UserControl):
         # This has to be done here because, before, the page is not created
         model_name = get_init_config(self.page)
         self.dd_model.value = model_name
-        self.text_model_info.value = self.model_confs.params_to_str(model_name)
+        self.text_model_info.value = self.__model_info(model_name)
+        self.update()
+
+        self.refresh_models()
+
+    def refresh_models(self) -> None:
+        """This function brings the index of downloaded models up to date in
+        the background, e.g., after a model has been downloaded, and then
+        updates the options and the information of the selected model."""
+        self.model_index.refresh_in_background(self.__update_models)
+
+    def __update_models(self) -> None:
+        if self.dd_model is None:
+            # Not built yet, so the options will be created from the index
+            return
+
+        self.dd_model.options = self.__create_model_name_options()
+        if self.dd_model.value is not None:
+            self.text_model_info.value = self.__model_info(self.dd_model.value)
         self.update()
 
     def set_conf_change_hook(self, hook):
         """This function sets the hook that is called when the user clicks the
         Apply button."""
         self.conf_change_hook = hook
+
+    def set_model_selected_hook(self, hook):
+        """This function sets the hook that is called when the user selects a
+        model from the dropdown, before clicking the Apply button."""
+        self.model_selected_hook = hook
@@ -0,0 +1,74 @@
+"""This module defines the `ContextWindow` class, which keeps the tokens of the
+conversation within the token budget of the model."""
+
+from typing import List, Optional
+
+
+class ContextWindow:
+    """This class keeps the conversation as a pinned system prefix followed by
+    a list of tokenized turns. When a new turn does not fit in the budget, the
+    oldest turns are evicted, so the size of the prompt, and hence the latency,
+    stays bounded however long the conversation runs."""
+
+    def __init__(self, system_ids: List[int], max_tokens: int, reserved_tokens: int):
+        """Initialize the context window. `max_tokens` is the maximum number of
+        tokens the model can attend to and `reserved_tokens` the number of them
+        kept free for the answer."""
+        self.system_ids = list(system_ids)
+        self.max_tokens = max_tokens
+        self.reserved_tokens = reserved_tokens
+        self.turns: List[List[int]] = []
+        self.pending_turn: Optional[List[int]] = None
+
+        if len(self.system_ids) >= self.budget:
+            raise ValueError(
+                f"The system prompt ({len(self.system_ids)} tokens) does not fit"
+                f" in the context window ({self.budget} tokens)"
+            )
+
+    @property
+    def budget(self) -> int:
+        """The maximum number of tokens of a prompt."""
+        return self.max_tokens - self.reserved_tokens
+
+    def num_tokens(self) -> int:
+        """This function returns the number of tokens of the conversation."""
+        return len(self.system_ids) + sum(len(turn) for turn in self.turns)
+
+    def ids(self) -> List[int]:
+        """This function returns the tokens of the conversation."""
+        ids = list(self.system_ids)
+        for turn in self.turns:
+            ids.extend(turn)
+
+        return ids
+
+    def begin_turn(self, turn_ids: List[int]) -> List[int]:
+        """This function starts a new turn with the given tokens and returns the
+        tokens of the prompt for it."""
+        if self.num_tokens() + len(turn_ids) > self.budget:
+            # Evict down to three quarters of the budget so that the next few
+            # turns fit without evicting again, which would invalidate the
+            # cached keys and values of the whole history each time
+            self._evict(self.budget * 3 // 4 - len(turn_ids))
+
+        # If the new turn alone does not fit, keep its end
+        free = self.budget - self.num_tokens()
+        self.pending_turn = list(turn_ids[-free:])
+
+        return self.ids() + self.pending_turn
+
+    def end_turn(self, answer_ids: List[int]) -> None:
+        """This function adds the answer to the turn started by `begin_turn`
+        and stores it in the history."""
+        if self.pending_turn is None:
+            raise ValueError("No turn in progress. You should call begin_turn first.")
+
+        self.turns.append(self.pending_turn + list(answer_ids))
+        self.pending_turn = None
+
+    def _evict(self, target: int) -> None:
+        """Remove the oldest turns until the conversation has at most `target`
+        tokens."""
+        while self.turns and self.num_tokens() > target:
+            self.turns.pop(0)
@@ -1,25 +1,86 @@
 """This module implements a Conversation class, which is used to display the
 conversation between the user and the chat bot as a flet component."""
-from typing import Optional
-from time import sleep
+from threading import Lock, Timer
+import time
+from typing import List, Optional
 
 import flet as ft
 
+from generation_metrics import GenerationMetrics
+
+# The fragments of an answer are sent to the browser at most this often, as
+# each update sends the whole message again
+FLUSH_INTERVAL_SEC = 0.05
+
+# The time a new bubble waits before growing in, so that its animation is seen
+BUBBLE_ANIMATION_DELAY_SEC = 0.1
+
+# Only the last messages have controls. Older ones are kept as text and shown
+# again, a few at a time, when the user asks for them.
+MAX_SHOWN_MESSAGES = 40
+NUM_EARLIER_MESSAGES = 20
+
+BOT_COLOR = ft.colors.PURPLE_300
+USER_COLOR = "#00c2b9"
+
+
+class _Message:
+    """This class holds a message of the conversation, so that its controls can
+    be built again after they have been dropped."""
+
+    def __init__(self, text: str, from_bot: bool, caption: Optional[str] = None):
+        self.text = text
+        self.from_bot = from_bot
+        # The elapsed time and metrics shown under messages from the chat bot
+        self.caption = caption
+
 
 class Conversation:
     """This class implements a Conversation component, which is used to display
     the conversation between the user and the chat bot as a flet component."""
 
-    def __init__(self):
+    def __init__(self, header: Optional[ft.Control] = None):
         """This function initializes the Conversation component. It creates the
-        main column where the conversation messages are held."""
-        self.col_conversation = ft.Column(controls=[])
+        list view where the conversation messages are held, which starts with
+        the given header. The list view scrolls by itself and should be
+        expanded to the available height."""
+        self.header = [] if header is None else [header]
+        self.button_earlier = ft.TextButton(
+            text="Show earlier messages",
+            icon=ft.icons.EXPAND_LESS,
+            on_click=self.on_show_earlier,
+            visible=False,
+        )
+        self.list_conversation = ft.ListView(
+            controls=[*self.header, self.button_earlier],
+            expand=True,
+            spacing=10,
+            auto_scroll=True,
+        )
+        # All the messages, the last `num_shown` of which have controls in the
+        # list view, after the header and the button
+        self.messages: List[_Message] = []
+        self.num_shown = 0
+        # The last message from the chat bot, which is not the last message if
+        # the user writes while it is answering, and the controls of its text
+        self.last_message_bot: Optional[_Message] = None
         self.last_text_bot = None
         self.last_text_elapsed = None
 
-    def _add_text_bubble(self, msg: str, bgcolor, margin) -> ft.Text:
+        # The fragments of the last message from the chat bot not shown yet,
+        # which are flushed from a timer or from the next fragment
+        self.lock = Lock()
+        self.pending = []
+        self.pending_elapsed_sec = None
+        self.last_flush = 0.0
+        self.flush_timer = None
+
+    def _build_message(self, message: _Message, visible: bool):
+        """This function builds the controls of a message. It returns the
+        control for the list view, the bubble, the text of the bubble and the
+        text of the caption, if any."""
         text = ft.Markdown(
-            value=msg,
+            value=message.text,
             # color=ft.colors.WHITE,
             extension_set="gitHubWeb",
             code_theme="atom-one-dark",
@@ -28,6 +89,11 @@ class Conversation:
             width=500,
         )
 
+        if message.from_bot:
+            bgcolor, margin = BOT_COLOR, 0
+        else:
+            bgcolor = USER_COLOR
+            margin = ft.Margin(top=0, left=150, right=0, bottom=0)
         bubble = ft.Container(
             content=text,
             bgcolor=bgcolor,
@@ -35,76 +101,178 @@ class Conversation:
             border_radius=30,
             animate_opacity=300,
             animate_scale=200,
-            scale=0,
-            opacity=0,
+            scale=1 if visible else 0,
+            opacity=1 if visible else 0,
             margin=margin,
         )
 
-        self.col_conversation.controls.append(bubble)
-        self.col_conversation.update()
-        bubble.update()
-        sleep(0.1)
+        if message.caption is None:
+            return bubble, bubble, text, None
+
+        text_elapsed = ft.Text(
+            value=message.caption,
+            style=ft.TextThemeStyle.BODY_SMALL,
+            color=ft.colors.BLACK38,
+        )
+        return ft.Column([bubble, text_elapsed]), bubble, text, text_elapsed
+
+    def _add_message(self, message: _Message):
+        """This function adds a message at the end of the conversation, making
+        its bubble grow in, and drops the controls of the oldest messages
+        shown if there are too many."""
+        control, bubble, text, text_elapsed = self._build_message(
+            message, visible=False
+        )
+        self.messages.append(message)
+        self.list_conversation.controls.append(control)
+        self.num_shown += 1
+        self._drop_earliest(self.num_shown - MAX_SHOWN_MESSAGES)
+        # Follow the end of the conversation again
+        self.list_conversation.auto_scroll = True
+        self.list_conversation.update()
+        # The bubble grows in later, without blocking the caller
+        Timer(
+            BUBBLE_ANIMATION_DELAY_SEC, self._show_bubble, args=(control, bubble)
+        ).start()
+
+        return text, text_elapsed
+
+    def _show_bubble(self, control: ft.Control, bubble: ft.Container) -> None:
+        # The message may have been dropped or cleared in the meantime
+        if control not in self.list_conversation.controls:
+            return
+
         bubble.scale = 1
         bubble.opacity = 1
         bubble.update()
 
-        return text
+    def _drop_earliest(self, num_messages: int) -> None:
+        """This function drops the controls of the given number of the oldest
+        messages shown. Their text is kept."""
+        if num_messages <= 0:
+            return
+
+        first = len(self.header) + 1
+        del self.list_conversation.controls[first : first + num_messages]
+        self.num_shown -= num_messages
+        self.button_earlier.visible = True
+
+    def on_show_earlier(self, event: ft.ControlEvent) -> None:
+        """This function is called when the user clicks the button to show
+        earlier messages. It builds the controls of some of the messages
+        before the ones shown."""
+        end = len(self.messages) - self.num_shown
+        start = max(0, end - NUM_EARLIER_MESSAGES)
+        first = len(self.header) + 1
+        self.list_conversation.controls[first:first] = [
+            self._build_message(message, visible=True)[0]
+            for message in self.messages[start:end]
+        ]
+        self.num_shown += end - start
+        self.button_earlier.visible = start > 0
+        # Stay at the earlier messages until a new one arrives
+        self.list_conversation.auto_scroll = False
+        self.list_conversation.update()
 
     def add_bot_msg(self, msg: str, elapsed_sec: Optional[float] = None) -> None:
         """This function adds a message from the chat bot to the conversation."""
-        self.last_text_bot = self._add_text_bubble(msg, ft.colors.PURPLE_300, margin=0)
-
-        text_elapsed = None
+        self.flush()
+        caption = None if elapsed_sec is None else ""
+        self.last_message_bot = _Message(msg, from_bot=True, caption=caption)
+        self.last_text_bot, self.last_text_elapsed = self._add_message(
+            self.last_message_bot
+        )
         if elapsed_sec is not None:
-            text_elapsed = ft.Text(
-                style=ft.TextThemeStyle.BODY_SMALL,
-                color=ft.colors.BLACK38,
-            )
-            self.col_conversation.controls.append(text_elapsed)
-            self.col_conversation.update()
-            self.last_text_elapsed = text_elapsed
             self.update_text_elapsed(elapsed_sec)
 
-        self.col_conversation.update()
-
     def append_bot_msg(self, msg: str, elapsed_sec: Optional[float] = None) -> None:
         """This function appends a message from the chat bot to the last message
-        from the chat bot."""
+        from the chat bot. The messages are shown together at most every
+        `FLUSH_INTERVAL_SEC`, so this never waits for the browser more often
+        than that."""
         if self.last_text_bot is None:
             raise ValueError(
                 "No previous bot message. You should call add_bot_msg first."
             )
 
-        self.last_text_bot.value += f"{msg}"
+        with self.lock:
+            self.pending.append(msg)
+            if elapsed_sec is not None:
+                self.pending_elapsed_sec = elapsed_sec
 
-        if self.last_text_elapsed is not None and elapsed_sec is not None:
-            self.update_text_elapsed(elapsed_sec)
+            wait = self.last_flush + FLUSH_INTERVAL_SEC - time.monotonic()
+            if wait <= 0:
+                self._flush()
+            elif self.flush_timer is None:
+                # Show the messages even if no other one arrives
+                self.flush_timer = Timer(wait, self.flush)
+                self.flush_timer.start()
 
-        self.last_text_bot.update()
+    def flush(self) -> None:
+        """This function shows the messages appended to the last message from
+        the chat bot that are not shown yet."""
+        with self.lock:
+            self._flush()
 
-    def update_text_elapsed(self, elapsed_sec):
-        """This function updates the elapsed time and words per second of the
-        last message from the chat bot."""
-        words = self.last_text_bot.value.split()
-        words_per_sec = len(words) / elapsed_sec
-        words_per_sec_str = f"({words_per_sec:.2f} words per sec)"
+    def _flush(self) -> None:
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+        if not self.pending or self.last_text_bot is None:
+            return
+
+        self.last_text_bot.value += "".join(self.pending)
+        self.last_message_bot.text = self.last_text_bot.value
+        self.pending = []
+        if self.last_text_elapsed is not None and self.pending_elapsed_sec is not None:
+            self.update_text_elapsed(self.pending_elapsed_sec)
+        self.last_text_bot.update()
+        self.last_flush = time.monotonic()
 
+    def update_text_elapsed(
+        self, elapsed_sec: float, metrics: Optional[GenerationMetrics] = None
+    ) -> None:
+        """This function updates the elapsed time of the last message from the
+        chat bot and, once the answer is complete, the metrics of its
+        generation."""
         if elapsed_sec < 60:
             elapsed_sec_str = f"{elapsed_sec:.0f} sec"
         else:
             elapsed_sec_str = f"{elapsed_sec // 60:.0f} min {elapsed_sec % 60:.0f} sec"
 
-        self.last_text_elapsed.value = f"{elapsed_sec_str} {words_per_sec_str}"
+        if metrics is not None:
+            elapsed_sec_str += f" ({metrics})"
+
+        self.last_message_bot.caption = elapsed_sec_str
+        self.last_text_elapsed.value = elapsed_sec_str
         self.last_text_elapsed.update()
 
+    def set_bot_metrics(
+        self, elapsed_sec: float, metrics: Optional[GenerationMetrics]
+    ) -> None:
+        """This function shows the metrics of the generation under the last
+        message from the chat bot, if it has an elapsed time."""
+        self.flush()
+        if self.last_text_elapsed is not None:
+            self.update_text_elapsed(elapsed_sec, metrics)
+
     def add_user_msg(self, msg: str) -> None:
         """This function adds a message from the user to the conversation."""
-        self._add_text_bubble(
-            msg, "#00c2b9", margin=ft.Margin(top=0, left=150, right=0, bottom=0)
-        )
+        self.flush()
+        self._add_message(_Message(msg, from_bot=False))
 
     def clear(self):
         """This function clears the conversation."""
+        with self.lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            self.pending = []
+        self.last_message_bot = None
         self.last_text_bot = None
-        self.col_conversation.controls = []
-        self.col_conversation.update()
+        self.last_text_elapsed = None
+        self.messages = []
+        self.num_shown = 0
+        self.button_earlier.visible = False
+        self.list_conversation.controls = [*self.header, self.button_earlier]
+        self.list_conversation.update()
@@ -0,0 +1,180 @@
+"""This module defines the `GenerationMetrics` class, which holds the metrics of
+the generation of an answer, and the `MetricsLog` class, which keeps the
+metrics of the last answers and, optionally, writes them to a JSON lines file
+for dashboards."""
+
+from collections import deque
+import json
+import os
+from threading import Lock
+import time
+from typing import List, Optional
+
+# If set, the metrics of every answer are appended to this file
+LOG_FILE_ENV_VAR = "LEONIA_METRICS_LOG"
+
+
+class GenerationMetrics:
+    """This class holds the metrics of the generation of an answer, measured
+    in tokens of the tokenizer of the model."""
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self.created = time.time()
+        # Tokens of the prompt, including the conversation so far, and how many
+        # of them were already in the cache
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.generated_tokens = 0
+        # From the message to the first token of the answer
+        self.time_to_first_token_sec: Optional[float] = None
+        # Running the model over the tokens of the prompt not in the cache
+        self.prefill_sec: Optional[float] = None
+        # Generating the tokens of the answer after the first one
+        self.decode_sec: Optional[float] = None
+        # Tokens proposed by the draft model, if any, and accepted by the model
+        self.draft_proposed_tokens = 0
+        self.draft_accepted_tokens = 0
+        self.cancelled = False
+
+    def decode_tokens_per_sec(self) -> Optional[float]:
+        """This function returns the decoding speed, or None if it could not be
+        measured, e.g., because the answer has a single token."""
+        if not self.decode_sec or self.generated_tokens < 2:
+            return None
+
+        return (self.generated_tokens - 1) / self.decode_sec
+
+    def draft_acceptance_rate(self) -> Optional[float]:
+        """This function returns the fraction of the tokens proposed by the
+        draft model that were accepted, or None if there is no draft model."""
+        if not self.draft_proposed_tokens:
+            return None
+
+        return self.draft_accepted_tokens / self.draft_proposed_tokens
+
+    def to_dict(self) -> dict:
+        """This function returns the metrics as a dictionary that can be
+        serialized to JSON."""
+        return {
+            "model": self.model_name,
+            "created": self.created,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "generated_tokens": self.generated_tokens,
+            "time_to_first_token_sec": self.time_to_first_token_sec,
+            "prefill_sec": self.prefill_sec,
+            "decode_sec": self.decode_sec,
+            "decode_tokens_per_sec": self.decode_tokens_per_sec(),
+            "draft_proposed_tokens": self.draft_proposed_tokens,
+            "draft_accepted_tokens": self.draft_accepted_tokens,
+            "draft_acceptance_rate": self.draft_acceptance_rate(),
+            "cancelled": self.cancelled,
+        }
+
+    @classmethod
+    def from_dict(cls, values: dict) -> "GenerationMetrics":
+        """This function returns the metrics of a dictionary made by
+        `to_dict`."""
+        metrics = cls(values["model"])
+        for name in (
+            "created",
+            "prompt_tokens",
+            "cached_tokens",
+            "generated_tokens",
+            "time_to_first_token_sec",
+            "prefill_sec",
+            "decode_sec",
+            "draft_proposed_tokens",
+            "draft_accepted_tokens",
+            "cancelled",
+        ):
+            setattr(metrics, name, values[name])
+
+        return metrics
+
+    def __str__(self) -> str:
+        parts = [
+            f"{self.prompt_tokens} prompt tokens ({self.cached_tokens} cached)",
+            f"{self.generated_tokens} generated",
+        ]
+        if self.time_to_first_token_sec is not None:
+            parts.append(f"first token in {self.time_to_first_token_sec:.2f} sec")
+        if self.prefill_sec is not None:
+            parts.append(f"prefill {self.prefill_sec * 1000:.0f} ms")
+        tokens_per_sec = self.decode_tokens_per_sec()
+        if tokens_per_sec is not None:
+            parts.append(f"{tokens_per_sec:.1f} tokens per sec")
+        acceptance_rate = self.draft_acceptance_rate()
+        if acceptance_rate is not None:
+            parts.append(f"{acceptance_rate:.0%} of draft tokens accepted")
+        if self.cancelled:
+            parts.append("stopped")
+
+        return ", ".join(parts)
+
+
+def _mean(values: List[Optional[float]]) -> Optional[float]:
+    values = [value for value in values if value is not None]
+    return sum(values) / len(values) if values else None
+
+
+def _ratio(numerator: int, denominator: int) -> Optional[float]:
+    return numerator / denominator if denominator else None
+
+
+class MetricsLog:
+    """This class keeps the metrics of the last answers, which can be used
+    from several threads."""
+
+    def __init__(self, max_answers: int = 1000, file_name: Optional[str] = None):
+        """Initialize the log. If `file_name` is given, the metrics of each
+        answer are also appended to it as a line of JSON."""
+        self.answers = deque(maxlen=max_answers)
+        self.file_name = file_name
+        self.lock = Lock()
+
+    @classmethod
+    def from_env(cls) -> "MetricsLog":
+        """This function returns a log that writes to the file given by the
+        `LEONIA_METRICS_LOG` environment variable, if set."""
+        return cls(file_name=os.environ.get(LOG_FILE_ENV_VAR))
+
+    def add(self, metrics: GenerationMetrics) -> None:
+        """This function adds the metrics of an answer."""
+        values = metrics.to_dict()
+        with self.lock:
+            self.answers.append(values)
+            if self.file_name is not None:
+                with open(self.file_name, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(values) + "\n")
+
+    def to_dict(self) -> dict:
+        """This function returns a summary of the metrics and the metrics of
+        each answer in the log, oldest first."""
+        with self.lock:
+            answers = list(self.answers)
+
+        return {
+            "summary": {
+                "answers": len(answers),
+                "mean_time_to_first_token_sec": _mean(
+                    [answer["time_to_first_token_sec"] for answer in answers]
+                ),
+                "mean_prefill_sec": _mean(
+                    [answer["prefill_sec"] for answer in answers]
+                ),
+                "mean_decode_tokens_per_sec": _mean(
+                    [answer["decode_tokens_per_sec"] for answer in answers]
+                ),
+                "cache_hit_rate": (
+                    sum(answer["cached_tokens"] for answer in answers)
+                    / max(1, sum(answer["prompt_tokens"] for answer in answers))
+                ),
+                "draft_acceptance_rate": _ratio(
+                    sum(answer["draft_accepted_tokens"] for answer in answers),
+                    sum(answer["draft_proposed_tokens"] for answer in answers),
+                ),
+            },
+            "answers": answers,
+        }
@@ -0,0 +1,39 @@
+"""This module defines the `IncrementalDecoder` class, which turns generated
+tokens into text one token at a time."""
+
+from typing import List
+
+
+class IncrementalDecoder:
+    """This class decodes the generated tokens incrementally. Only the last
+    few tokens are decoded on each step, instead of the whole answer, and text
+    is only returned once it is complete, so multi-byte characters split
+    between tokens and tokens that merge with the previous ones are handled
+    correctly."""
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.ids: List[int] = []
+        # Tokens before `prefix_offset` are never decoded again. The text of
+        # the tokens between `prefix_offset` and `read_offset` has already
+        # been returned.
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def push(self, token_id: int) -> str:
+        """This function adds a token and returns the new text it completes,
+        which may be empty."""
+        self.ids.append(token_id)
+
+        prefix_text = self.tokenizer.decode(
+            self.ids[self.prefix_offset : self.read_offset]
+        )
+        new_text = self.tokenizer.decode(self.ids[self.prefix_offset :])
+
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            return ""
+
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.ids)
+
+        return new_text[len(prefix_text) :]
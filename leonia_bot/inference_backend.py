@@ -0,0 +1,143 @@
+"""This module defines the interface of the engines that run the models, the
+`InferenceBackend` class, and its PyTorch implementation. The backend of each
+model is chosen with the `backend` field of its configuration."""
+
+from typing import Optional, Tuple
+
+import torch
+from transformers import AutoModelForCausalLM
+
+from quantization import load_quantized
+
+# The supported values of the `backend` field of the model configurations
+BACKENDS = ("pytorch", "onnxruntime")
+
+
+class InferenceBackend:
+    """This class is the interface of the engines that run the models. The chat
+    bot only uses a model through it: it is loaded with `load`, and `forward`
+    runs it over new tokens given the cached keys and values of the previous
+    ones, either to prefill the prompt or to decode the next token of one or
+    more conversations. The answer is streamed by the chat bot on top of that.
+
+    The keys and values are tuples with a pair of torch tensors per layer, of
+    shape (batch, heads, tokens, head size), whatever the backend, so that
+    storing the system prompt, cropping the cache and batching conversations
+    work the same with all of them."""
+
+    # The data type of the keys and values
+    dtype: torch.dtype
+    # The maximum number of tokens the model can see
+    max_position_embeddings: int
+
+    @classmethod
+    def load(
+        cls, repo: str, conf, quantization: Optional[str] = None
+    ) -> "InferenceBackend":
+        """This function loads the model of the given repository with the
+        options of the given `ChatBotConf`, quantized with the given method,
+        if any."""
+        raise NotImplementedError
+
+    def forward(
+        self,
+        input_ids: torch.Tensor,
+        past_key_values: Optional[Tuple] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, Tuple]:
+        """This function runs the model over the given tokens, of shape (batch,
+        tokens), which follow those of the cached keys and values, if any. The
+        attention mask, which covers the cached tokens and the new ones, and
+        the position ids are only needed for padded batches. It returns the
+        logits for each token, as float32 of shape (batch, tokens, vocabulary
+        size), and the keys and values of all the tokens."""
+        raise NotImplementedError
+
+    def memory_bytes(self) -> int:
+        """This function returns the memory used by the weights of the
+        model."""
+        raise NotImplementedError
+
+
+class PyTorchBackend(InferenceBackend):
+    """This class runs the models with PyTorch and transformers."""
+
+    def __init__(self, model):
+        self.model = model
+        self.dtype = model.dtype
+        self.max_position_embeddings = model.config.max_position_embeddings
+
+    @classmethod
+    def load(
+        cls, repo: str, conf, quantization: Optional[str] = None
+    ) -> "PyTorchBackend":
+        if quantization is None:
+            model = AutoModelForCausalLM.from_pretrained(repo, **conf.load_kwargs())
+        else:
+            model = load_quantized(
+                repo,
+                quantization,
+                lambda: AutoModelForCausalLM.from_pretrained(
+                    repo, **conf.load_kwargs()
+                ),
+            )
+        model.eval()
+
+        return cls(model)
+
+    @torch.no_grad()
+    def forward(
+        self,
+        input_ids: torch.Tensor,
+        past_key_values: Optional[Tuple] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, Tuple]:
+        output = self.model(
+            input_ids=input_ids,
+            past_key_values=past_key_values,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            use_cache=True,
+        )
+        past_key_values = output.past_key_values
+        if hasattr(past_key_values, "to_legacy_cache"):
+            # Newer versions of transformers return a cache object that is
+            # updated in place, which would modify the shared keys and values
+            # of the system prompt
+            past_key_values = past_key_values.to_legacy_cache()
+
+        return output.logits.float(), past_key_values
+
+    def memory_bytes(self) -> int:
+        """The state dict is used, instead of the parameters, because the
+        weights of quantized layers are not parameters; tied weights are
+        counted once."""
+        tensors = {}
+        for value in self.model.state_dict().values():
+            # Quantized linear layers store their weights as a tuple of tensors
+            for tensor in value if isinstance(value, tuple) else (value,):
+                if isinstance(tensor, torch.Tensor):
+                    size = tensor.numel() * tensor.element_size()
+                    tensors[tensor.data_ptr()] = size
+
+        return sum(tensors.values())
+
+
+def load_backend(
+    backend: str, repo: str, conf, quantization: Optional[str] = None
+) -> InferenceBackend:
+    """This function loads the model of the given repository with the given
+    backend, one of `BACKENDS`."""
+    if backend == "pytorch":
+        return PyTorchBackend.load(repo, conf, quantization)
+    if backend == "onnxruntime":
+        # Imported here so that ONNX Runtime is only needed if it is used
+        from onnx_backend import (  # pylint: disable=import-outside-toplevel
+            OnnxRuntimeBackend,
+        )
+
+        return OnnxRuntimeBackend.load(repo, conf, quantization)
+
+    raise ValueError(f"Invalid backend: {backend}. Valid values: {BACKENDS}")
@@ -0,0 +1,230 @@
+"""This module runs the chat bot in a separate process, so that loading the
+model and generating answers never block the flet application. The
+application talks to the worker through a pipe: it sends commands (load or
+preload a model, submit a message, clear the conversation, cancel the answer)
+and the worker streams back log output, fragments of the answers and their
+metrics. Loaded models are kept in a `ModelCache`, so switching back to a model
+is fast."""
+
+from contextlib import redirect_stderr, redirect_stdout
+import multiprocessing
+from multiprocessing.connection import Connection
+from queue import Queue
+import sys
+from threading import Event, Lock, Thread
+from typing import Iterator, Optional, TextIO, Tuple
+
+from generation_metrics import GenerationMetrics, MetricsLog
+
+# The time the worker is given to exit before it is terminated
+EXIT_TIMEOUT_SEC = 5
+
+
+class _PipeWriter:
+    """This class sends everything written to it through the pipe as log
+    messages. It is used to redirect the output of the worker."""
+
+    def __init__(self, conn: Connection):
+        self.conn = conn
+
+    def write(self, msg: str) -> None:
+        """This function sends the text through the pipe."""
+        self.conn.send(("log", msg))
+
+    def flush(self) -> None:
+        """This function does nothing, as messages are sent as written."""
+
+
+class _CommandReader:
+    """This class reads the commands sent to the worker in a background
+    thread. Each answer gets its own cancellation event, which is set as soon
+    as a command that interrupts it arrives, even while the main thread of the
+    worker is busy generating."""
+
+    def __init__(self, conn: Connection):
+        self.conn = conn
+        self.commands = Queue()
+        self.cancel = None
+        Thread(target=self._read, daemon=True).start()
+
+    def _read(self) -> None:
+        while True:
+            try:
+                command = self.conn.recv()
+            except EOFError:
+                command = ("exit",)
+
+            if command[0] == "submit":
+                self.cancel = Event()
+                command = (*command, self.cancel)
+            elif command[0] != "preload" and self.cancel is not None:
+                # Any other command but preloading interrupts the answer in
+                # progress
+                self.cancel.set()
+
+            self.commands.put(command)
+            if command[0] == "exit":
+                break
+
+    def get(self) -> Tuple:
+        """This function returns the next command."""
+        return self.commands.get()
+
+
+def _worker_main(conn: Connection) -> None:
+    """This function is the entry point of the worker process. It owns the
+    chat bot and handles the commands received through the pipe."""
+    # Imported here so that the application process never loads them
+    from model_cache import ModelCache  # pylint: disable=import-outside-toplevel
+    from model_configurations import (  # pylint: disable=import-outside-toplevel
+        ModelConfigurations,
+    )
+
+    log = _PipeWriter(conn)
+    commands = _CommandReader(conn)
+    metrics_log = MetricsLog.from_env()
+    models = None
+    chat_bot = None
+    while True:
+        kind, *args = commands.get()
+        try:
+            if kind in ("load", "preload") and models is None:
+                models = ModelCache(ModelConfigurations(args[0]))
+
+            if kind == "load":
+                # Drop the reference to the previous model, so that the cache
+                # can free it before loading the new one
+                chat_bot = None
+                with redirect_stdout(log), redirect_stderr(log):
+                    chat_bot = models.get(args[1])
+                conn.send(("loaded",))
+            elif kind == "preload":
+                models.preload(args[1])
+            elif kind == "submit":
+                user_msg, cancel = args
+                for fragment in chat_bot.get_answer(user_msg, cancel):
+                    conn.send(("fragment", fragment))
+                metrics_log.add(chat_bot.last_metrics)
+                conn.send(("metrics", chat_bot.last_metrics.to_dict()))
+                conn.send(("end",))
+            elif kind == "clear":
+                if chat_bot is not None:
+                    chat_bot.reset()
+            elif kind == "exit":
+                break
+            # A "cancel" has already done its work in the command reader
+        except Exception as error:  # pylint: disable=broad-except
+            # The error is the last reply to the command
+            conn.send(("error", repr(error)))
+
+
+class InferenceWorker:
+    """This class starts the worker process and sends commands to it."""
+
+    def __init__(self, conf_file_name: str):
+        """Start the worker process. `conf_file_name` is the file with the model
+        configurations, which is read by the worker."""
+        self.conf_file_name = conf_file_name
+
+        # "spawn" gives the worker a fresh interpreter, which is safe with the
+        # threads of flet and torch
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, args=(child_conn,), daemon=True
+        )
+        self.process.start()
+
+        # Commands can be sent from different flet event handlers. Replies are
+        # read by one of them at a time, from the command to its last reply.
+        self.send_lock = Lock()
+        self.receive_lock = Lock()
+
+        # The metrics of the last answer
+        self.last_metrics: Optional[GenerationMetrics] = None
+
+    def _send(self, *command) -> None:
+        with self.send_lock:
+            self.conn.send(command)
+
+    def _receive_until(self, last_kind: str) -> Iterator[Tuple]:
+        """This function yields the messages from the worker until one of the
+        given kind arrives. Errors in the worker are raised here."""
+        with self.receive_lock:
+            while True:
+                kind, *args = self.conn.recv()
+                if kind == last_kind:
+                    return
+                if kind == "error":
+                    raise RuntimeError(f"Error in the inference worker: {args[0]}")
+
+                yield kind, args
+
+    def load_model(self, model_name: str, log: TextIO) -> str:
+        """Load the given model in the worker, replacing the previous one. The
+        output of the worker while loading is written to `log`. The last line
+        written, which reports how the model was loaded, is returned."""
+        self._send("load", self.conf_file_name, model_name)
+        last_line = ""
+        for _, args in self._receive_until("loaded"):
+            log.write(args[0])
+            if args[0].strip():
+                last_line = args[0].strip()
+
+        return last_line
+
+    def get_answer(self, user_msg: str) -> Iterator[str]:
+        """Get the answer for the given user message as a stream of fragments
+        of text. If the caller stops early, the answer is cancelled. The
+        metrics of the answer are left in `last_metrics` at the end."""
+        self.last_metrics = None
+        self._send("submit", user_msg)
+        replies = self._receive_until("end")
+        try:
+            for kind, args in replies:
+                if kind == "fragment":
+                    yield args[0]
+                elif kind == "metrics":
+                    self.last_metrics = GenerationMetrics.from_dict(args[0])
+                else:
+                    sys.stderr.write(args[0])
+        except GeneratorExit:
+            # Read the rest of the replies, so that they are not taken as the
+            # replies of the next command
+            self.cancel()
+            for _ in replies:
+                pass
+            raise
+
+    def preload(self, model_name: str) -> None:
+        """Load the given model in the background, if it is downloaded and fits
+        in the memory budget of the worker, so that switching to it is fast.
+        The answer in progress, if any, is not interrupted."""
+        self._send("preload", self.conf_file_name, model_name)
+
+    def clear(self) -> None:
+        """Start a new conversation. An answer in progress is cancelled."""
+        self._send("clear")
+
+    def cancel(self) -> None:
+        """Stop the answer in progress, if any. The part of the answer already
+        received is kept in the conversation."""
+        self._send("cancel")
+
+    def close(self) -> None:
+        """Stop the worker process, which frees the memory of its models. If it
+        does not exit within `EXIT_TIMEOUT_SEC`, e.g., because it is loading a
+        model, it is terminated. Closing a closed worker does nothing."""
+        if self.conn.closed:
+            return
+
+        try:
+            self._send("exit")
+        except (OSError, ValueError):
+            # The worker has already exited
+            pass
+        self.process.join(EXIT_TIMEOUT_SEC)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.conn.close()
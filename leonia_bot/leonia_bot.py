@@ -1,50 +1,69 @@
 """This is a flet application that uses the chat_bot module to implement a chat
 bot."""
 
-from contextlib import redirect_stderr, redirect_stdout
+import os
+import re
+from threading import Lock, Thread
 import time
 import flet as ft
 
-from chat_bot import ChatBot, BOT_NAME
+# The model libraries are only imported by the inference worker, so the page
+# is shown right away
+from bot_name import BOT_NAME
+from chat_client import ChatServerClient
 from conversation import Conversation
 from configuration import ConfigurationControl, get_init_config
+from inference_worker import InferenceWorker
+from log_view import LOG_FILE_ENV_VAR, UPDATE_INTERVAL_SEC, LogView
 from model_configurations import ModelConfigurations
 
 INITIAL_MSG = "Hello, how can I help you?"
 
+# If set, the application uses the chat server at this URL, shared with other
+# users, instead of loading the model in its own inference worker
+SERVER_URL_ENV_VAR = "LEONIA_SERVER_URL"
 
-class TextWithWrite(ft.Text):
-    """This class is used to redirect the output of the chat bot to the log
-    text control."""
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.value = ""
-        self.lines = []
+class LoadProgress:
+    """This class shows the progress of loading a model. The output of the
+    inference worker is written to the log, and the percentage of the last
+    progress bar in it, e.g., of a download, is shown in a progress bar, at
+    most every `UPDATE_INTERVAL_SEC` while the percentage changes."""
+
+    PERCENTAGE = re.compile(r"(\d+)%\|")
+
+    def __init__(
+        self, log: LogView, progress_bar: ft.ProgressBar, progress_text: ft.Text
+    ):
+        self.log = log
+        self.progress_bar = progress_bar
+        self.progress_text = progress_text
+        self.last_update = 0.0
 
     def write(self, msg: str) -> None:
-        """This function is called when the chat bot prints something. It
-        appends the text to the log text control."""
-
-        # If the new line contains "Downloading" and there are previous lines
-        # with "Downloading", leave only the new one. This happens when
-        # huggingface downloads the model to show the download progress.
-        if "Downloading" in msg:
-            lines = [l for l in self.lines if "Downloading" not in l]
-            lines.append(msg)
-            self.lines = lines
+        """This function writes the output to the log and updates the progress
+        bar."""
+        self.log.write(msg)
+
+        matches = list(self.PERCENTAGE.finditer(msg))
+        if matches:
+            percentage = int(matches[-1].group(1))
+            now = time.monotonic()
+            if percentage < 100 and now - self.last_update < UPDATE_INTERVAL_SEC:
+                return
+            self.last_update = now
+            description = msg[: matches[-1].start()].strip(" \r\n:")
+            self.progress_bar.value = percentage / 100
+            self.progress_text.value = f"{description} {percentage}%"
+        elif msg.startswith("Loading"):
+            # Loading from disk, which does not report its progress
+            self.progress_bar.value = None
+            self.progress_text.value = msg.strip()
         else:
-            if msg not in ("\r", msg != "\n"):
-                self.lines.append(msg)
-
-        self.value = ("").join(self.lines)
-        self.update()
+            return
 
-    def reset(self) -> None:
-        """Reset the log text control."""
-        self.value = ""
-        self.lines = []
-        self.update()
+        self.progress_bar.update()
+        self.progress_text.update()
 
 
 class ChatBotApp:
@@ -67,9 +86,14 @@ class ChatBotApp:
 
         self.model_confs = ModelConfigurations("model_confs.yaml")
 
-        configuration_control = ConfigurationControl(page, self.model_confs)
-        col_content = ft.Column(controls=[img], auto_scroll=True, scroll=True)
-        col_config = ft.Column(controls=[configuration_control])
+        self.configuration_control = ConfigurationControl(page, self.model_confs)
+        # The conversation scrolls by itself, between the image, which scrolls
+        # with it, and the controls below
+        self.conversation = Conversation(header=img)
+        col_content = ft.Column(
+            controls=[self.conversation.list_conversation], expand=True
+        )
+        col_config = ft.Column(controls=[self.configuration_control])
 
         self.tabs = ft.Tabs(
             expand=1,
@@ -81,6 +105,7 @@ class ChatBotApp:
                     content=ft.Container(
                         content=col_content,
                         padding=ft.Padding(left=0, top=10, right=0, bottom=0),
+                        expand=True,
                     ),
                 ),
                 ft.Tab(text="Configuration", content=col_config),
@@ -89,29 +114,44 @@ class ChatBotApp:
 
         page.add(self.tabs)
 
-        self.chat_bot = None
-        self.conversation = Conversation()
-        col_content.controls.append(self.conversation.col_conversation)
-
-        self.progress_text = ft.Text("I'm turning on. Please wait...")
+        if SERVER_URL_ENV_VAR in os.environ:
+            self.worker = ChatServerClient(os.environ[SERVER_URL_ENV_VAR])
+        else:
+            self.worker = InferenceWorker("model_confs.yaml")
+        # The worker holds a model, so it is stopped when the page is closed
+        # or reloaded, which starts a new session with its own worker
+        page.on_disconnect = self.on_disconnect
+        page.on_close = self.on_disconnect
+
+        self.progress_text = ft.Text()
+        self.progress_bar = ft.ProgressBar(width=400, visible=False)
         self.progress = ft.Column(
-            [ft.ProgressRing(), self.progress_text],
+            [ft.ProgressRing(), self.progress_bar, self.progress_text],
             horizontal_alignment=ft.CrossAxisAlignment.CENTER,
+            visible=False,
         )
         col_content.controls.append(self.progress)
 
         # Create a text control for the log
-        self.text_log = TextWithWrite()
+        self.text_log = LogView(file_name=os.environ.get(LOG_FILE_ENV_VAR))
         col_content.controls.append(self.text_log)
-        page.update()
 
-        self.model_name = get_init_config(page)
-        self.init_model()
+        # The model is loaded in the background. Messages sent before it is
+        # ready are queued and answered once it is loaded. Each load gets a new
+        # id, so that a load replaced by another one does not answer them.
+        # Likewise, each answer gets a new id, so that an answer that was
+        # cleared stops writing to the conversation.
+        self.lock = Lock()
+        self.model_ready = False
+        self.queued_msgs = []
+        self.load_id = 0
+        self.answer_id = 0
 
-        configuration_control.set_conf_change_hook(self.change_conf)
+        self.model_name = get_init_config(page)
 
-        self.progress.visible = False
-        self.progress.controls[1].value = "Thinking..."
+        self.configuration_control.set_conf_change_hook(self.change_conf)
+        # Start loading the selected model while the user decides to apply it
+        self.configuration_control.set_model_selected_hook(self.worker.preload)
 
         if self.model_name == "DISTILGPT2":
             self.conversation.add_bot_msg(
@@ -121,6 +161,11 @@ class ChatBotApp:
             )
         self.conversation.add_bot_msg(INITIAL_MSG)
 
+        button_stop = ft.FilledButton(
+            text="Stop",
+            icon=ft.icons.STOP,
+            on_click=self.on_stop,
+        )
         button_clear = ft.FilledButton(
             text="Clear",
             icon=ft.icons.CLEAR,
@@ -139,25 +184,94 @@ class ChatBotApp:
         )
 
         row_input = ft.Row(
-            [self.tf_input, button_submit, button_clear],
+            [self.tf_input, button_submit, button_stop, button_clear],
         )
         col_content.controls.append(row_input)
         page.update()
 
-    def init_model(self):
-        """Initialize the chat bot with the model stored in the model field."""
-        with redirect_stdout(self.text_log), redirect_stderr(self.text_log):
-            self.chat_bot = ChatBot(self.model_name, self.model_confs)
-            self.chat_bot.initialize()
+        self.start_loading()
+
+    def start_loading(self) -> None:
+        """Start loading the model stored in the model field in the
+        background, showing its progress."""
+        with self.lock:
+            self.model_ready = False
+            self.load_id += 1
+            load_id = self.load_id
+
+        self.progress_text.value = "I'm turning on. Please wait..."
+        self.progress_bar.value = None
+        self.progress_bar.visible = True
+        self.progress.visible = True
+        self.progress.update()
+
+        Thread(target=self.init_model, args=(load_id,), daemon=True).start()
+
+    def init_model(self, load_id: int) -> None:
+        """Initialize the chat bot with the model stored in the model field,
+        and then answer the messages sent while it was loading. The model is
+        loaded in the inference worker. Only the report of the load time and
+        peak memory is left in the log. This runs in a background thread
+        started by `start_loading`."""
+        try:
+            report = self.worker.load_model(
+                self.model_name,
+                LoadProgress(self.text_log, self.progress_bar, self.progress_text),
+            )
+        except Exception as error:  # pylint: disable=broad-except
+            report = None
+            load_error = error
+
+        # A load replaced by a newer one leaves the progress of the newer one
+        # alone
+        with self.lock:
+            if load_id != self.load_id:
+                return
+
+        if report is None:
+            # The messages stay queued until another model is loaded
+            self.text_log.write(f"\n{load_error}")
+            self.progress_text.value = "I couldn't turn on. Try another model."
+            self.progress_bar.visible = False
+            self.progress.update()
+            return
 
         self.text_log.reset()
-        self.text_log.visible = False
-        self.text_log.update()
+        self.text_log.write(report)
+        # The model may have been downloaded
+        self.configuration_control.refresh_models()
+        self.progress_bar.visible = False
+        self.progress.visible = False
+        self.progress.update()
+
+        try:
+            while True:
+                with self.lock:
+                    if load_id != self.load_id:
+                        return
+                    if not self.queued_msgs:
+                        self.model_ready = True
+                        return
+                    human_msg = self.queued_msgs.pop(0)
+
+                try:
+                    self.answer(human_msg)
+                except Exception as error:  # pylint: disable=broad-except
+                    # The next messages are still answered
+                    self.text_log.write(f"\n{error}")
+                    self.progress.visible = False
+                    self.progress.update()
+        finally:
+            # Messages are never queued forever, even if answering fails
+            with self.lock:
+                if load_id == self.load_id:
+                    self.model_ready = True
 
     def on_submit(self, event: ft.ControlEvent) -> None:
         """This function is called when the user clicks the Submit button. It
         sends the message to the chat bot and displays the answer in the
-        conversation."""
+        conversation. If the model is not loaded yet, the message is answered
+        as soon as it is."""
         human_msg = self.tf_input.value
 
         # If the user clicks the Submit button without entering a message,
@@ -170,26 +284,54 @@ class ChatBotApp:
 
         self.conversation.add_user_msg(human_msg)
 
+        with self.lock:
+            if not self.model_ready:
+                self.queued_msgs.append(human_msg)
+                return
+
+        self.answer(human_msg)
+
+    def _is_current_answer(self, answer_id: int) -> bool:
+        with self.lock:
+            return answer_id == self.answer_id
+
+    def answer(self, human_msg: str) -> None:
+        """This function sends the message to the chat bot and displays the
+        answer in the conversation. If the conversation is cleared meanwhile,
+        the answer is cancelled and nothing more is displayed."""
+        with self.lock:
+            self.answer_id += 1
+            answer_id = self.answer_id
+
+        self.progress_text.value = "Thinking..."
         self.progress.visible = True
         self.progress.update()
 
         start = time.time()
-        answer_iterator = self.chat_bot.get_answer(human_msg)
-        answer = next(answer_iterator)
+        answer_iterator = self.worker.get_answer(human_msg)
+        answer = next(answer_iterator, "")
         end = time.time()
         elapsed_sec = end - start
 
+        if not self._is_current_answer(answer_id):
+            # Closing the iterator cancels the answer
+            answer_iterator.close()
+            return
         self.conversation.add_bot_msg(answer, elapsed_sec)
 
         for answer in answer_iterator:
+            if not self._is_current_answer(answer_id):
+                answer_iterator.close()
+                return
             end = time.time()
             elapsed_sec = end - start
-            try:
-                self.conversation.append_bot_msg(answer, elapsed_sec)
-            except:
-                # This can happen if the user clicks "Clear" while the AI is
-                # thinking
-                return
+            self.conversation.append_bot_msg(answer, elapsed_sec)
+
+        if not self._is_current_answer(answer_id):
+            return
+        self.conversation.set_bot_metrics(
+            time.time() - start, self.worker.last_metrics
+        )
 
         self.progress.visible = False
         self.progress.update()
@@ -197,39 +339,63 @@ class ChatBotApp:
         self.tf_input.update()
         self.tf_input.focus()
 
+    def on_stop(self, event: ft.ControlEvent) -> None:
+        """This function is called when the user clicks the Stop button. It
+        stops the answer in progress, keeping the part already shown, or
+        drops the messages waiting for the model to load."""
+        with self.lock:
+            self.queued_msgs.clear()
+            if not self.model_ready:
+                return
+
+        self.worker.cancel()
+
     def on_clear(self, event: ft.ControlEvent) -> None:
         """This function is called when the user clicks the Clear button. It
-        clears the conversation."""
+        clears the conversation, cancelling the answer in progress before
+        the conversation is touched."""
+        with self.lock:
+            self.queued_msgs.clear()
+            self.answer_id += 1
+            model_ready = self.model_ready
+
+        if model_ready:
+            self.worker.clear()
         self.conversation.clear()
         self.conversation.add_bot_msg(INITIAL_MSG)
-        self.progress.visible = False
-        self.progress.update()
+        if model_ready:
+            self.progress.visible = False
+            self.progress.update()
+
+    def on_disconnect(self, event: ft.ControlEvent) -> None:
+        """This function is called when the page session ends. It stops the
+        inference worker, or ends the session in the chat server."""
+        with self.lock:
+            self.queued_msgs.clear()
+        self.worker.close()
 
     def change_conf(self, new_model_name: str) -> None:
         """This function is called when the user changes the chat bot. It
-        clears the conversation and displays the initial message."""
+        clears the conversation, displays the initial message and loads the
+        new model in the background."""
         self.tabs.selected_index = 0
         self.tabs.update()
 
-        self.progress.visible = True
-        self.progress.update()
-
         if new_model_name == self.model_name:
             return
 
         self.model_name = new_model_name
+        with self.lock:
+            self.queued_msgs.clear()
+            self.answer_id += 1
 
-        self.chat_bot = ChatBot(self.model_name, self.model_confs)
         self.text_log.reset()
         self.text_log.visible = True
 
-        self.init_model()
-
         self.conversation.clear()
         self.conversation.add_bot_msg(INITIAL_MSG)
 
-        self.progress.visible = False
-        self.progress.update()
+        self.start_loading()
 
 
 def main(page: ft.Page):
@@ -238,4 +404,7 @@ def main(page: ft.Page):
     ChatBotApp(page)
 
 
-ft.app(target=main, port=8733, view=ft.WEB_BROWSER, assets_dir="./")
+# The guard keeps the inference worker, which imports this module when it is
+# spawned, from starting the application again
+if __name__ == "__main__":
+    ft.app(target=main, port=8733, view=ft.WEB_BROWSER, assets_dir="./")
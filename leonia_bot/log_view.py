@@ -0,0 +1,137 @@
+"""This module implements the `LogView` class, a flet text control that shows
+the output of the chat bot, e.g., while a model is downloaded or loaded."""
+
+from collections import deque
+import logging
+from logging.handlers import RotatingFileHandler
+import os
+import re
+from threading import Lock, Timer
+import time
+from typing import Optional
+
+import flet as ft
+
+# If set, the log is also written to this file, which is rotated
+LOG_FILE_ENV_VAR = "LEONIA_LOG_FILE"
+
+# Only the last lines are kept
+MAX_LINES = 200
+
+# The text is sent to the browser at most this often
+UPDATE_INTERVAL_SEC = 0.25
+
+# The size of the log file before it is rotated, and the rotated files kept
+MAX_FILE_BYTES = 1024**2
+NUM_BACKUP_FILES = 3
+
+_LINE_BREAKS = re.compile(r"(\r\n|\r|\n)")
+
+# The loggers of the log files, by absolute file name
+_file_loggers = {}
+_file_loggers_lock = Lock()
+
+
+def _file_logger(file_name: str) -> logging.Logger:
+    """This function returns the logger that writes to the given file. The log
+    views of all the pages share it, so that a single handler writes and
+    rotates the file."""
+    file_name = os.path.abspath(file_name)
+    with _file_loggers_lock:
+        if file_name not in _file_loggers:
+            handler = RotatingFileHandler(
+                file_name, maxBytes=MAX_FILE_BYTES, backupCount=NUM_BACKUP_FILES
+            )
+            handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            logger = logging.getLogger(f"{__name__}.file{len(_file_loggers)}")
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
+            logger.addHandler(handler)
+            _file_loggers[file_name] = logger
+
+        return _file_loggers[file_name]
+
+
+class LogView(ft.Text):
+    """This class is used to redirect the output of the chat bot to a text
+    control. A line ended by a carriage return, as progress bars write them,
+    is replaced by the next one, so a progress bar takes a single line."""
+
+    def __init__(self, *args, file_name: Optional[str] = None, **kwargs):
+        """Initialize the control. If `file_name` is given, the complete lines
+        are also written to it."""
+        super().__init__(*args, **kwargs)
+        self.value = ""
+        self.lines = deque(maxlen=MAX_LINES)
+        # The line being written, which is replaced if it ends with "\r"
+        self.current = ""
+        self.replace_current = False
+
+        self.lock = Lock()
+        self.last_update = 0.0
+        self.update_timer = None
+
+        self.file_logger = None if file_name is None else _file_logger(file_name)
+
+    def write(self, msg: str) -> None:
+        """This function is called when the chat bot prints something. It adds
+        the text to the log, which is shown at most every
+        `UPDATE_INTERVAL_SEC`."""
+        with self.lock:
+            for part in _LINE_BREAKS.split(msg):
+                if part in ("\n", "\r\n"):
+                    self._end_line()
+                elif part == "\r":
+                    self.replace_current = True
+                elif part:
+                    if self.replace_current:
+                        self.current = ""
+                        self.replace_current = False
+                    self.current += part
+
+            wait = self.last_update + UPDATE_INTERVAL_SEC - time.monotonic()
+            if wait <= 0:
+                self._show()
+            elif self.update_timer is None:
+                # Show the text even if nothing else is written
+                self.update_timer = Timer(wait, self.flush)
+                self.update_timer.start()
+
+    def _end_line(self) -> None:
+        line = self.current
+        self.current = ""
+        self.replace_current = False
+        if self.file_logger is not None:
+            self.file_logger.info(line)
+
+        # Huggingface shows a progress bar for each file it downloads. Only the
+        # last one is kept.
+        if self.lines and "Downloading" in line and "Downloading" in self.lines[-1]:
+            self.lines[-1] = line
+        else:
+            self.lines.append(line)
+
+    def flush(self) -> None:
+        """This function shows the text written so far."""
+        with self.lock:
+            self._show()
+
+    def _show(self) -> None:
+        if self.update_timer is not None:
+            self.update_timer.cancel()
+            self.update_timer = None
+
+        lines = list(self.lines)
+        if self.current:
+            lines.append(self.current)
+        self.value = "\n".join(lines)
+        self.update()
+        self.last_update = time.monotonic()
+
+    def reset(self) -> None:
+        """Reset the log text control."""
+        with self.lock:
+            self.lines.clear()
+            self.current = ""
+            self.replace_current = False
+            self._show()
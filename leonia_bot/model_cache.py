@@ -0,0 +1,211 @@
+"""This module defines the `ModelCache` class, which keeps recently used chat
+bots, with their models and tokenizers, in memory up to a memory budget."""
+
+from collections import Counter, OrderedDict
+import gc
+import os
+from threading import Lock, Thread
+from typing import Iterable, Optional
+
+from chat_bot import ChatBot
+from model_configurations import GB, ModelConfigurations, required_bytes
+from model_index import ModelIndex
+
+# The budget can be set with this environment variable, in GB
+BUDGET_ENV_VAR = "LEONIA_MODEL_MEMORY_GB"
+
+
+class ModelDoesNotFit(RuntimeError):
+    """This exception is raised when a model does not fit in the memory budget
+    because of the pinned models, which cannot be evicted."""
+
+
+def default_budget() -> int:
+    """This function returns the memory budget for the models in bytes. If it
+    is not set in the environment, half the physical memory is used."""
+    if BUDGET_ENV_VAR in os.environ:
+        return int(float(os.environ[BUDGET_ENV_VAR]) * GB)
+
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2
+    except (ValueError, OSError, AttributeError):
+        # Not available on this platform: keep only the model in use
+        return 0
+
+
+def _model_bytes(chat_bot: ChatBot) -> int:
+    """This function returns the memory used by the weights of the model and
+    its draft model, if any."""
+    size = chat_bot.backend.memory_bytes()
+    if chat_bot.draft_model is not None:
+        size += chat_bot.draft_model.backend.memory_bytes()
+
+    return size
+
+
+class ModelCache:
+    """This class keeps the loaded chat bots in least recently used order.
+    Before loading a model, the least recently used ones are evicted until the
+    new one fits in the budget, using the `requirements` field of its
+    configuration as an estimate. Once loaded, the actual size of its weights
+    is used instead.
+
+    Models are only preloaded if they are already downloaded, and a preload
+    still waiting for another load is skipped once a newer model is requested,
+    so browsing models never delays the one that is finally used.
+
+    Models can be pinned while something else, e.g., a session of the chat
+    server, still uses them, and pinned models are never evicted, as evicting
+    them would free no memory. A model that does not fit because of them is
+    not loaded."""
+
+    def __init__(self, model_confs: ModelConfigurations, budget: Optional[int] = None):
+        self.model_confs = model_confs
+        self.budget = default_budget() if budget is None else budget
+        self.chat_bots = OrderedDict()
+        self.sizes = {}
+        # The number of users of each pinned model. They have their own lock,
+        # so that a model can be unpinned while another one is loaded.
+        self.pins = Counter()
+        self.pins_lock = Lock()
+        self.model_index = ModelIndex()
+        # Only one model is loaded at a time
+        self.load_lock = Lock()
+        # A new object for each request to get or preload a model
+        self.last_request = None
+
+    def used_bytes(self) -> int:
+        """This function returns the memory used by the cached models."""
+        return sum(self.sizes.values())
+
+    def get(self, model_name: str, pin: bool = False) -> ChatBot:
+        """This function returns the chat bot for the given model, loading it
+        if it is not cached, with a new conversation. If `pin` is True, the
+        model is not evicted until `unpin` is called. It raises
+        `ModelDoesNotFit` if the model does not fit in the budget because of
+        pinned models."""
+        # Preloads waiting for the lock are skipped
+        self.last_request = object()
+        with self.load_lock:
+            if model_name in self.chat_bots:
+                print(f"Using cached {self.model_confs.repo(model_name)}")
+                self.chat_bots.move_to_end(model_name)
+                chat_bot = self.chat_bots[model_name]
+                chat_bot.reset()
+            else:
+                chat_bot = self._load(model_name, keep=())
+
+            if pin:
+                with self.pins_lock:
+                    self.pins[model_name] += 1
+
+        return chat_bot
+
+    def unpin(self, model_name: str) -> None:
+        """This function releases a pin of the given model taken by `get`."""
+        with self.pins_lock:
+            self.pins[model_name] -= 1
+            if self.pins[model_name] <= 0:
+                del self.pins[model_name]
+
+    def _pinned(self) -> set:
+        with self.pins_lock:
+            return set(self.pins)
+
+    def preload(self, model_name: str) -> None:
+        """This function loads the given model in a background thread, if it
+        is downloaded and fits in the budget without evicting the model in
+        use, if any. It is skipped if another model is requested before it
+        starts."""
+        request = object()
+        self.last_request = request
+        Thread(target=self._preload, args=(model_name, request), daemon=True).start()
+
+    def _is_downloaded(self, model_name: str) -> bool:
+        """This function returns whether the model, and its draft model, if
+        any, are downloaded, so that preloading them downloads nothing."""
+        params = self.model_confs.params(model_name)
+        self.model_index.refresh()
+        return all(
+            self.model_index.is_downloaded(repo)
+            for repo in (params["repo"], params.get("draft_repo"))
+            if repo is not None
+        )
+
+    def _preload(self, model_name: str, request: object) -> None:
+        if not self._is_downloaded(model_name):
+            return
+
+        with self.load_lock:
+            if self.last_request is not request or model_name in self.chat_bots:
+                return
+            if not self.chat_bots:
+                self._load(model_name, keep=())
+                return
+
+            in_use = next(reversed(self.chat_bots))
+            needed = required_bytes(self.model_confs.params(model_name))
+            kept = {in_use, *self._pinned()}
+            if sum(self.sizes[name] for name in kept) + needed > self.budget:
+                return
+
+            try:
+                self._load(model_name, keep=(in_use,))
+            except ModelDoesNotFit:
+                # It does not fit with the pinned models after all
+                return
+            # The model in use stays the most recently used one
+            self.chat_bots.move_to_end(in_use)
+
+    def _load(self, model_name: str, keep: Iterable[str]) -> ChatBot:
+        needed = required_bytes(self.model_confs.params(model_name))
+        self._evict(self.budget - needed, keep)
+        self._check_pinned(model_name, needed)
+
+        chat_bot = ChatBot(model_name, self.model_confs)
+        chat_bot.initialize()
+
+        self.chat_bots[model_name] = chat_bot
+        self.sizes[model_name] = _model_bytes(chat_bot)
+        self._evict(self.budget, keep=(*keep, model_name))
+        try:
+            # The estimate may have been too low
+            self._check_pinned(model_name, 0)
+        except ModelDoesNotFit:
+            del self.chat_bots[model_name]
+            del self.sizes[model_name]
+            del chat_bot
+            gc.collect()
+            raise
+
+        return chat_bot
+
+    def _check_pinned(self, model_name: str, needed: int) -> None:
+        """This function raises `ModelDoesNotFit` if the cached models, and
+        `needed` more bytes, exceed the budget because of pinned models other
+        than the given one."""
+        pinned_bytes = sum(
+            self.sizes[name] for name in self._pinned() if name != model_name
+        )
+        if pinned_bytes and self.used_bytes() + needed > self.budget:
+            raise ModelDoesNotFit(
+                f"Not enough memory for {model_name}: {pinned_bytes / GB:.1f} GB"
+                f" are used by models still in use, and the budget is"
+                f" {self.budget / GB:.1f} GB"
+            )
+
+    def _evict(self, target: int, keep: Iterable[str]) -> None:
+        """Remove the least recently used models, except those in `keep` and
+        the pinned ones, until the cached ones use at most `target` bytes."""
+        pinned = self._pinned()
+        for model_name in list(self.chat_bots):
+            if self.used_bytes() <= target:
+                break
+            if model_name in keep or model_name in pinned:
+                continue
+
+            print(f"Unloading {self.model_confs.repo(model_name)}")
+            del self.chat_bots[model_name]
+            del self.sizes[model_name]
+
+        gc.collect()
@@ -1,7 +1,25 @@
 """This module defines a class to work with model configurations."""
 
+import re
+
 import yaml
 
+GB = 1024**3
+
+
+def required_bytes(params: dict, resource: str = "RAM") -> int:
+    """This function returns the RAM, or the disk space if `resource` is
+    "disk", needed by a model according to the `requirements` field of its
+    configuration, e.g., "16 GB RAM (CPU), 14 GB disk", or 0 if it is not
+    given."""
+    match = re.search(
+        rf"(\d+(?:\.\d+)?)\s*GB {resource}", params.get("requirements", "")
+    )
+    if match is None:
+        return 0
+
+    return int(float(match.group(1)) * GB)
+
 
 class ModelConfigurations:
 
@@ -0,0 +1,206 @@
+"""This module defines the `ModelIndex` class, which keeps an index of the
+models downloaded to the Hugging Face cache, with their sizes. Unlike
+`huggingface_hub.scan_cache_dir`, which reads every file of every snapshot
+each time, the index is stored on disk and only the repositories whose files
+changed since it was stored are read again. It has no heavy dependencies, so
+the flet application can use it."""
+
+import hashlib
+import json
+import os
+from threading import Lock, Thread
+from typing import Callable, Optional
+
+INDEX_FILE = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "leonia_bot",
+    "model_index.json",
+)
+
+
+def hub_cache_dir() -> str:
+    """This function returns the directory of the Hugging Face cache, following
+    the same environment variables as `huggingface_hub`."""
+    for env_var in ("HF_HUB_CACHE", "HUGGINGFACE_HUB_CACHE"):
+        if env_var in os.environ:
+            return os.path.expanduser(os.environ[env_var])
+
+    hf_home = os.environ.get(
+        "HF_HOME",
+        os.path.join(
+            os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+            "huggingface",
+        ),
+    )
+    return os.path.join(os.path.expanduser(hf_home), "hub")
+
+
+def _repo_dir_name(repo_id: str) -> str:
+    return "models--" + repo_id.replace("/", "--")
+
+
+def model_revision(repo: str) -> Optional[str]:
+    """This function returns what identifies the version of the files of the
+    given model, so that what is computed from them can be cached: the commit
+    of the repository in the Hugging Face cache, or a hash of the sizes and
+    modification times of the files of a local directory. It returns None if
+    the repository has not been downloaded yet."""
+    if os.path.isdir(repo):
+        stats = []
+        with os.scandir(repo) as entries:
+            for entry in sorted(entries, key=lambda entry: entry.name):
+                if entry.is_file():
+                    stat = entry.stat()
+                    stats.append(f"{entry.name} {stat.st_size} {stat.st_mtime_ns}")
+        return hashlib.sha256("\n".join(stats).encode("utf-8")).hexdigest()
+
+    refs_file = os.path.join(hub_cache_dir(), _repo_dir_name(repo), "refs", "main")
+    try:
+        with open(refs_file, "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+class ModelIndex:
+    """This class holds the index of the downloaded models. For each
+    repository, it stores the size of its files and the modification time of
+    the directory that holds them, which changes when a file is added or
+    removed, so that the index can tell which repositories to read again."""
+
+    def __init__(self, cache_dir: Optional[str] = None, index_file: str = INDEX_FILE):
+        self.cache_dir = cache_dir or hub_cache_dir()
+        self.index_file = index_file
+        self.lock = Lock()
+        # The entries by name of the directory of the repository
+        self.repos = self._load()
+
+    def _load(self) -> dict:
+        """This function reads the index stored on disk, if it is for the same
+        cache directory."""
+        try:
+            with open(self.index_file, "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+        if index.get("cache_dir") != self.cache_dir:
+            return {}
+
+        return index["repos"]
+
+    def _save(self) -> None:
+        os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+        # Write to a temporary file first, so that a crash, or another process
+        # saving at the same time, never leaves a truncated index behind
+        tmp_file = f"{self.index_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"cache_dir": self.cache_dir, "repos": self.repos}, f)
+        os.replace(tmp_file, self.index_file)
+
+    def _blobs_dir(self, dir_name: str) -> str:
+        return os.path.join(self.cache_dir, dir_name, "blobs")
+
+    def _scan_repo(self, dir_name: str) -> Optional[dict]:
+        """This function reads the files of a repository and returns its entry,
+        or None if it has no complete file. Only the blobs are read, as the
+        files of the snapshots are links to them."""
+        blobs_dir = self._blobs_dir(dir_name)
+        try:
+            mtime = os.stat(blobs_dir).st_mtime_ns
+            size = 0
+            num_files = 0
+            with os.scandir(blobs_dir) as entries:
+                for entry in entries:
+                    # Files still being downloaded end with ".incomplete"
+                    if entry.is_file() and not entry.name.endswith(".incomplete"):
+                        size += entry.stat().st_size
+                        num_files += 1
+        except OSError:
+            return None
+
+        if num_files == 0:
+            return None
+
+        repo_id = dir_name[len("models--") :].replace("--", "/")
+        return {"repo_id": repo_id, "size": size, "mtime": mtime}
+
+    def _is_current(self, dir_name: str) -> bool:
+        try:
+            mtime = os.stat(self._blobs_dir(dir_name)).st_mtime_ns
+        except OSError:
+            return False
+
+        return self.repos[dir_name]["mtime"] == mtime
+
+    def refresh(self) -> bool:
+        """This function brings the index up to date with the cache, reading
+        only the repositories that changed, and returns whether the index
+        changed. Changes saved by other processes, e.g., the inference worker,
+        are read from disk first."""
+        with self.lock:
+            old_repos = self.repos
+            self.repos = self._load()
+
+            try:
+                with os.scandir(self.cache_dir) as entries:
+                    dir_names = [
+                        entry.name
+                        for entry in entries
+                        if entry.name.startswith("models--") and entry.is_dir()
+                    ]
+            except OSError:
+                dir_names = []
+
+            repos = {}
+            for dir_name in dir_names:
+                if dir_name in self.repos and self._is_current(dir_name):
+                    repos[dir_name] = self.repos[dir_name]
+                else:
+                    entry = self._scan_repo(dir_name)
+                    if entry is not None:
+                        repos[dir_name] = entry
+
+            saved = repos == self.repos
+            self.repos = repos
+            if not saved:
+                self._save()
+
+            return repos != old_repos
+
+    def refresh_in_background(self, on_change: Callable[[], None]) -> None:
+        """This function refreshes the index in a background thread, calling
+        `on_change` from it if the index changed."""
+
+        def refresh():
+            if self.refresh():
+                on_change()
+
+        Thread(target=refresh, daemon=True).start()
+
+    def refresh_repo(self, repo_id: str) -> None:
+        """This function reads the files of the given repository again, e.g.,
+        after downloading it, and saves the index."""
+        dir_name = _repo_dir_name(repo_id)
+        with self.lock:
+            self.repos = self._load()
+            entry = self._scan_repo(dir_name)
+            if entry is None:
+                self.repos.pop(dir_name, None)
+            else:
+                self.repos[dir_name] = entry
+            self._save()
+
+    def is_downloaded(self, repo_id: str) -> bool:
+        """This function returns whether the given repository is downloaded. A
+        local directory is always available."""
+        if os.path.isdir(repo_id):
+            return True
+
+        return _repo_dir_name(repo_id) in self.repos
+
+    def downloaded_bytes(self, repo_id: str) -> int:
+        """This function returns the size of the files of the given repository
+        in the cache, or 0 if it is not downloaded."""
+        entry = self.repos.get(_repo_dir_name(repo_id))
+        return 0 if entry is None else entry["size"]
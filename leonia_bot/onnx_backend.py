@@ -0,0 +1,238 @@
+"""This module defines the `OnnxRuntimeBackend` class, which runs the models
+with ONNX Runtime on the CPU. Each model is exported to ONNX only once, and
+stored on disk with its keys and values as inputs and outputs, so that the
+backend keeps the cache between steps like the PyTorch one."""
+
+import hashlib
+import json
+import os
+import shutil
+from typing import Optional, Tuple
+
+import numpy as np
+import onnxruntime
+import torch
+import transformers
+from transformers import AutoConfig, AutoModelForCausalLM
+
+from inference_backend import InferenceBackend
+from model_index import model_revision
+
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "leonia_bot",
+    "onnx",
+)
+
+OPSET_VERSION = 14
+
+
+class _ExportedModel(torch.nn.Module):
+    """This class wraps a model so that its cached keys and values are flat
+    lists of inputs and outputs, as ONNX needs."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, position_ids, *past):
+        """This function runs the model and returns the logits followed by the
+        keys and values of each layer."""
+        output = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=tuple(zip(past[::2], past[1::2])),
+            use_cache=True,
+            return_dict=True,
+        )
+        present = output.past_key_values
+        if hasattr(present, "to_legacy_cache"):
+            present = present.to_legacy_cache()
+
+        return (output.logits, *(tensor for layer in present for tensor in layer))
+
+
+def _path(repo: str) -> str:
+    revision = model_revision(repo)
+    if revision is None:
+        # Download the configuration, so that the commit of the model is known
+        AutoConfig.from_pretrained(repo)
+        revision = model_revision(repo)
+
+    # The export depends on the files of the model and on its code in
+    # transformers
+    key = (
+        f"{repo}\n{revision}\n{OPSET_VERSION}\n{torch.__version__}\n"
+        f"{transformers.__version__}"
+    )
+    name = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, name)
+
+
+def export(repo: str, conf, path: str) -> None:
+    """This function exports the model of the given repository, in float32, to
+    the given directory, loading it with the options of the given
+    `ChatBotConf`. Models of more than 2 GB have their weights in separate
+    files next to the model."""
+    kwargs = conf.load_kwargs()
+    kwargs["torch_dtype"] = torch.float32
+    model = AutoModelForCausalLM.from_pretrained(repo, **kwargs)
+    model.eval()
+
+    # The shapes of the keys and values are taken from a real step, which
+    # also gives the cached tokens the export is traced with
+    with torch.no_grad():
+        past = model(input_ids=torch.tensor([[0, 1, 2]]), use_cache=True)
+    past = past.past_key_values
+    if hasattr(past, "to_legacy_cache"):
+        past = past.to_legacy_cache()
+    _, num_heads, _, head_size = past[0][0].shape
+
+    num_layers = len(past)
+    past_names = [
+        f"past_{kind}_{layer}" for layer in range(num_layers) for kind in ("key", "value")
+    ]
+    present_names = [name.replace("past", "present") for name in past_names]
+    dynamic_axes = {
+        "input_ids": {0: "batch", 1: "tokens"},
+        "attention_mask": {0: "batch", 1: "all_tokens"},
+        "position_ids": {0: "batch", 1: "tokens"},
+        "logits": {0: "batch", 1: "tokens"},
+    }
+    for name in past_names:
+        dynamic_axes[name] = {0: "batch", 2: "past_tokens"}
+    for name in present_names:
+        dynamic_axes[name] = {0: "batch", 2: "all_tokens"}
+
+    # Export to a temporary directory of this process first, so that a crash
+    # never leaves a partial export behind, and another process exporting the
+    # same model at the same time does not write to it
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    with torch.no_grad():
+        torch.onnx.export(
+            _ExportedModel(model),
+            (
+                torch.tensor([[3, 4]]),
+                torch.ones((1, 5), dtype=torch.long),
+                torch.tensor([[3, 4]]),
+                *(tensor for layer in past for tensor in layer),
+            ),
+            os.path.join(tmp_path, "model.onnx"),
+            input_names=["input_ids", "attention_mask", "position_ids", *past_names],
+            output_names=["logits", *present_names],
+            dynamic_axes=dynamic_axes,
+            opset_version=OPSET_VERSION,
+            do_constant_folding=True,
+        )
+
+    with open(os.path.join(tmp_path, "config.json"), "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "num_layers": num_layers,
+                "num_heads": num_heads,
+                "head_size": head_size,
+                "max_position_embeddings": model.config.max_position_embeddings,
+            },
+            f,
+        )
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # Another process finished the same export first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.isdir(path):
+            raise
+
+
+class OnnxRuntimeBackend(InferenceBackend):
+    """This class runs the models with ONNX Runtime on the CPU, in float32."""
+
+    dtype = torch.float32
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, "config.json"), "r", encoding="utf-8") as f:
+            config = json.load(f)
+        self.path = path
+        self.num_layers = config["num_layers"]
+        self.num_heads = config["num_heads"]
+        self.head_size = config["head_size"]
+        self.max_position_embeddings = config["max_position_embeddings"]
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(path, "model.onnx"),
+            options,
+            providers=["CPUExecutionProvider"],
+        )
+        # The exporter drops the inputs the model does not use
+        self.input_names = {node.name for node in self.session.get_inputs()}
+
+    @classmethod
+    def load(
+        cls, repo: str, conf, quantization: Optional[str] = None
+    ) -> "OnnxRuntimeBackend":
+        if quantization is not None:
+            raise ValueError(
+                "Quantization is only supported by the pytorch backend, not by"
+                " onnxruntime"
+            )
+
+        path = _path(repo)
+        if os.path.exists(path):
+            print(f"Loading {repo} exported to ONNX from {path}")
+        else:
+            print(f"Exporting {repo} to ONNX in {path}")
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            export(repo, conf, path)
+
+        return cls(path)
+
+    def forward(
+        self,
+        input_ids: torch.Tensor,
+        past_key_values: Optional[Tuple] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, Tuple]:
+        batch, num_new = input_ids.shape
+        if past_key_values is None:
+            empty = torch.zeros((batch, self.num_heads, 0, self.head_size))
+            past_key_values = ((empty, empty),) * self.num_layers
+        num_past = past_key_values[0][0].shape[2]
+
+        if attention_mask is None:
+            attention_mask = torch.ones((batch, num_past + num_new), dtype=torch.long)
+        if position_ids is None:
+            position_ids = torch.arange(num_past, num_past + num_new).expand(
+                batch, num_new
+            )
+
+        feeds = {
+            "input_ids": input_ids.numpy(),
+            "attention_mask": attention_mask.numpy(),
+            "position_ids": np.ascontiguousarray(position_ids.numpy()),
+        }
+        for layer, (key, value) in enumerate(past_key_values):
+            # Cropped keys and values are views that must be copied
+            feeds[f"past_key_{layer}"] = np.ascontiguousarray(key.numpy())
+            feeds[f"past_value_{layer}"] = np.ascontiguousarray(value.numpy())
+
+        feeds = {name: feed for name, feed in feeds.items() if name in self.input_names}
+        logits, *present = self.session.run(None, feeds)
+
+        return torch.from_numpy(logits), tuple(
+            (torch.from_numpy(key), torch.from_numpy(value))
+            for key, value in zip(present[::2], present[1::2])
+        )
+
+    def memory_bytes(self) -> int:
+        """The size of the exported model on disk is used as an estimate."""
+        return sum(
+            entry.stat().st_size for entry in os.scandir(self.path) if entry.is_file()
+        )
@@ -0,0 +1,73 @@
+"""This module stores on disk the cached keys and values of the system prompt,
+so that they are computed only once per model, version of its files, prompt and
+data type."""
+
+import hashlib
+import os
+from typing import Callable, Optional, Tuple
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "leonia_bot",
+    "prefix_cache",
+)
+
+
+def prefix_key(repo: str, revision: str, prompt: str, dtype: torch.dtype) -> str:
+    """This function returns the hash that identifies the cached prefix. The
+    revision, as given by `model_index.model_revision`, keeps a model whose
+    files are updated from reading the keys and values of the old ones."""
+    key = f"{repo}\n{revision}\n{dtype}\n{prompt}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def _path(key: str) -> str:
+    return os.path.join(CACHE_DIR, f"{key}.safetensors")
+
+
+def load_prefix(key: str) -> Optional[Tuple]:
+    """This function loads the cached keys and values stored with the given
+    key, or returns None if there are none. All the layers are read into
+    memory, as every answer attends to the whole system prompt."""
+    path = _path(key)
+    if not os.path.exists(path):
+        return None
+
+    with safe_open(path, framework="pt") as f:
+        num_layers = len(f.keys()) // 2
+        return tuple(
+            (f.get_tensor(f"key_{layer}"), f.get_tensor(f"value_{layer}"))
+            for layer in range(num_layers)
+        )
+
+
+def save_prefix(key: str, past_key_values) -> None:
+    """This function stores the given keys and values on disk."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tensors = {}
+    for layer, (key_states, value_states) in enumerate(past_key_values):
+        tensors[f"key_{layer}"] = key_states.contiguous()
+        tensors[f"value_{layer}"] = value_states.contiguous()
+
+    # Write to a temporary file first, so that a crash, or another process
+    # saving the same prefix at the same time, never leaves a truncated cache
+    # behind
+    path = _path(key)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    save_file(tensors, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_or_compute_prefix(key: str, compute: Callable[[], Tuple]) -> Tuple:
+    """This function returns the cached keys and values for the given key,
+    calling `compute` and storing the result if they are not on disk yet."""
+    past_key_values = load_prefix(key)
+    if past_key_values is None:
+        past_key_values = compute()
+        save_prefix(key, past_key_values)
+
+    return past_key_values
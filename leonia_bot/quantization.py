@@ -0,0 +1,74 @@
+"""This module quantizes models for faster inference on the CPU and stores the
+quantized models on disk, so that the conversion is done only once."""
+
+import hashlib
+import os
+from typing import Callable
+
+import torch
+import transformers
+from transformers import AutoConfig
+
+from model_index import model_revision
+
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "leonia_bot",
+    "quantized",
+)
+
+# The supported values of the `quantization` field of the model configurations
+QUANTIZATIONS = ("dynamic_int8",)
+
+
+def quantize(model: torch.nn.Module, quantization: str) -> torch.nn.Module:
+    """This function returns the model quantized with the given method. With
+    "dynamic_int8", the weights of the linear layers are stored as int8 and
+    their activations are quantized on the fly."""
+    if quantization == "dynamic_int8":
+        return torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+
+    raise ValueError(
+        f"Invalid quantization: {quantization}. Valid values: {QUANTIZATIONS}"
+    )
+
+
+def _path(repo: str, quantization: str) -> str:
+    revision = model_revision(repo)
+    if revision is None:
+        # Download the configuration, so that the commit of the model is known
+        AutoConfig.from_pretrained(repo)
+        revision = model_revision(repo)
+
+    # The pickled model is only valid for the files and the versions that
+    # created it
+    key = (
+        f"{repo}\n{revision}\n{quantization}\n{torch.__version__}\n"
+        f"{transformers.__version__}"
+    )
+    name = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, f"{name}.pt")
+
+
+def load_quantized(
+    repo: str, quantization: str, load: Callable[[], torch.nn.Module]
+) -> torch.nn.Module:
+    """This function returns the quantized model for the given repository. If
+    it is not on disk, it is loaded with `load`, quantized and stored."""
+    path = _path(repo, quantization)
+    if os.path.exists(path):
+        print(f"Loading {repo} quantized with {quantization} from {path}")
+        return torch.load(path, weights_only=False)
+
+    model = quantize(load(), quantization)
+
+    print(f"Saving {repo} quantized with {quantization} to {path}")
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # Another process may be saving the same model at the same time
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(model, tmp_path)
+    os.replace(tmp_path, path)
+
+    return model
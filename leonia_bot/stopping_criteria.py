@@ -0,0 +1,54 @@
+"""This module defines the stopping criteria used to end an answer of the chat
+bot as soon as the model writes one of the markers of the conversation or the
+answer is cancelled."""
+
+from threading import Event
+from typing import List
+
+import torch
+from transformers import StoppingCriteria
+
+
+def cut_at_markers(text: str, markers: List[str]) -> str:
+    """This function returns the text before the first marker it contains."""
+    for marker in markers:
+        text = text.split(marker)[0]
+
+    return text
+
+
+def has_new_marker(text: str, markers: List[str], num_new_chars: int) -> bool:
+    """This function returns whether the text contains a marker that ends in
+    its last `num_new_chars` characters, i.e., one completed by the text just
+    added. Only the end of the text is inspected, however many tokens the
+    model used to write the marker."""
+    return any(
+        marker in text[-(len(marker) + num_new_chars) :] for marker in markers if marker
+    )
+
+
+def held_back_length(text: str, markers: List[str]) -> int:
+    """This function returns the length of the end of the text that cannot be
+    shown yet because it could be the beginning of a marker. Only the end of
+    the text is inspected."""
+    held_back = 0
+    for marker in markers:
+        for length in range(min(len(marker) - 1, len(text)), held_back, -1):
+            if marker.startswith(text[-length:]):
+                held_back = length
+                break
+
+    return held_back
+
+
+class StopOnEvent(StoppingCriteria):
+    """This class stops the generation once the given event is set. It is used
+    to cancel an answer from another thread."""
+
+    def __init__(self, event: Event):
+        self.event = event
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs
+    ) -> bool:
+        return self.event.is_set()
@@ -0,0 +1,32 @@
+"""The modules of the application import each other by name, as they are run
+from the `leonia_bot` directory, so the tests do the same."""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "leonia_bot"))
+
+
+@pytest.fixture(scope="session")
+def tiny_model_dir(tmp_path_factory):
+    """The directory of the tiny model of the benchmark, with random weights,
+    which is built locally so that the tests do not download anything."""
+    from benchmark import build_tiny_model  # pylint: disable=import-outside-toplevel
+
+    path = tmp_path_factory.mktemp("tiny-random")
+    build_tiny_model(str(path))
+    return str(path)
+
+
+@pytest.fixture(autouse=True, scope="session")
+def prefix_cache_dir(tmp_path_factory):
+    """The keys and values of the system prompts are stored in a temporary
+    directory, not in the cache of the user."""
+    import prefix_cache  # pylint: disable=import-outside-toplevel
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        path = tmp_path_factory.mktemp("prefix_cache")
+        monkeypatch.setattr(prefix_cache, "CACHE_DIR", str(path))
+        yield str(path)
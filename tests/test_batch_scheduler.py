@@ -0,0 +1,134 @@
+"""Tests of the `BatchScheduler` class. Greedy answers, and the logits they
+are chosen from, must be the same whether the decoding steps of several
+conversations are batched, with their padding, attention mask and position
+ids, or each conversation runs on its own."""
+
+from itertools import islice
+import os
+from threading import Barrier, Thread
+
+import pytest
+import torch
+from transformers import AutoTokenizer, GPTNeoXConfig, GPTNeoXForCausalLM
+import yaml
+
+from benchmark import MESSAGES, TINY_MODEL_NAME
+from chat_bot import ChatBot
+from model_configurations import ModelConfigurations
+
+NUM_TURNS = 2
+NUM_TOKENS = 16
+
+
+def _greedy_confs(path: str, repo: str) -> ModelConfigurations:
+    """This function returns the configuration of the tiny model of the
+    benchmark, with the weights of the given repository, and greedy decoding,
+    so that the answers can be compared."""
+    with open(os.path.join(path, "model_confs.yaml"), "r", encoding="utf-8") as f:
+        confs = yaml.safe_load(f)
+    params = confs[TINY_MODEL_NAME]
+    params.update(repo=repo, do_sample=False, padding=True)
+
+    conf_file_name = os.path.join(repo, "greedy_confs.yaml")
+    with open(conf_file_name, "w", encoding="utf-8") as f:
+        yaml.safe_dump(confs, f)
+
+    return ModelConfigurations(conf_file_name)
+
+
+@pytest.fixture(name="gpt2_confs", scope="module")
+def fixture_gpt2_confs(tiny_model_dir):
+    return _greedy_confs(tiny_model_dir, tiny_model_dir)
+
+
+@pytest.fixture(name="gpt_neox_confs", scope="module")
+def fixture_gpt_neox_confs(tiny_model_dir, tmp_path_factory):
+    """A tiny GPT-NeoX model, whose rotary embeddings depend on the position
+    ids, with the tokenizer of the tiny model of the benchmark."""
+    path = str(tmp_path_factory.mktemp("tiny-gpt-neox"))
+    tokenizer = AutoTokenizer.from_pretrained(tiny_model_dir)
+    config = GPTNeoXConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        intermediate_size=128,
+        max_position_embeddings=2048,
+        bos_token_id=tokenizer.eos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+    )
+    torch.manual_seed(0)
+    GPTNeoXForCausalLM(config).save_pretrained(path)
+    tokenizer.save_pretrained(path)
+
+    return _greedy_confs(tiny_model_dir, path)
+
+
+def _conversation(chat_bot: ChatBot, first_message: int) -> tuple:
+    """This function holds a conversation, starting at the given message so
+    that the conversations have different lengths, and returns the tokens of
+    the answers and the logits each token was chosen from. A fixed number of
+    tokens is generated for each answer, as the model, with random weights,
+    may write the end of the answer at once."""
+    all_logits = []
+    sample = chat_bot._sample  # pylint: disable=protected-access
+
+    def recording_sample(logits):
+        all_logits.append(logits)
+        return sample(logits)
+
+    chat_bot._sample = recording_sample  # pylint: disable=protected-access
+
+    ids = list(chat_bot.system_ids)
+    answers = []
+    for turn in range(NUM_TURNS):
+        message = MESSAGES[(first_message + turn) % len(MESSAGES)]
+        ids += chat_bot.tokenizer.encode(message)
+        tokens = chat_bot._tokens(ids)  # pylint: disable=protected-access
+        answer = list(islice(tokens, NUM_TOKENS))
+        # Closing the tokens takes the conversation out of the batch
+        tokens.close()
+        ids += answer
+        answers.append(answer)
+
+    return answers, torch.stack(all_logits)
+
+
+@pytest.mark.parametrize("confs_fixture", ["gpt2_confs", "gpt_neox_confs"])
+def test_batched_answers_are_the_same(request, confs_fixture):
+    model_confs = request.getfixturevalue(confs_fixture)
+    template = ChatBot(TINY_MODEL_NAME, model_confs)
+    template.initialize()
+
+    expected = [_conversation(template.fork(), i) for i in range(len(MESSAGES))]
+
+    # Record the size of the batches, to check that the steps were batched
+    batch_sizes = []
+    forward = template.backend.forward
+
+    def recording_forward(input_ids, *args, **kwargs):
+        batch_sizes.append(input_ids.shape[0])
+        return forward(input_ids, *args, **kwargs)
+
+    template.backend.forward = recording_forward
+    template.enable_batching()
+    chat_bots = [template.fork() for _ in MESSAGES]
+    answers = [None] * len(chat_bots)
+    barrier = Barrier(len(chat_bots))
+
+    def converse(index):
+        barrier.wait()
+        answers[index] = _conversation(chat_bots[index], index)
+
+    threads = [Thread(target=converse, args=(i,)) for i in range(len(chat_bots))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(batch_sizes) > 1
+    for (answer, logits), (expected_answer, expected_logits) in zip(
+        answers, expected
+    ):
+        assert answer == expected_answer
+        torch.testing.assert_close(logits, expected_logits, rtol=1e-4, atol=1e-4)
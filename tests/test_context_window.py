@@ -0,0 +1,63 @@
+"""Tests of the `ContextWindow` class, which keeps the conversation within the
+token budget of the model."""
+
+import pytest
+
+from context_window import ContextWindow
+
+
+def test_system_prompt_must_fit():
+    with pytest.raises(ValueError):
+        ContextWindow(list(range(10)), max_tokens=12, reserved_tokens=2)
+
+
+def test_turns_are_kept_while_they_fit():
+    window = ContextWindow([0, 1], max_tokens=100, reserved_tokens=10)
+    assert window.begin_turn([2, 3]) == [0, 1, 2, 3]
+    window.end_turn([4])
+    assert window.begin_turn([5]) == [0, 1, 2, 3, 4, 5]
+    window.end_turn([6, 7])
+    assert window.ids() == [0, 1, 2, 3, 4, 5, 6, 7]
+    assert window.num_tokens() == 8
+
+
+def test_oldest_turns_are_evicted_and_system_prompt_is_pinned():
+    system_ids = [0, 1]
+    window = ContextWindow(system_ids, max_tokens=24, reserved_tokens=4)
+    for turn in range(5):
+        prompt = window.begin_turn([100 + turn] * 3)
+        assert prompt[:2] == system_ids
+        assert len(prompt) <= window.budget
+        window.end_turn([200 + turn] * 2)
+
+    # The last turns are kept whole, in order, and the first ones evicted
+    ids = window.ids()
+    assert ids[:2] == system_ids
+    assert ids[-5:] == [104] * 3 + [204] * 2
+    assert 100 not in ids
+
+
+def test_eviction_leaves_room_for_the_next_turns():
+    window = ContextWindow([0], max_tokens=41, reserved_tokens=1)
+    for _ in range(7):
+        window.begin_turn([1] * 4)
+        window.end_turn([2])
+    assert window.num_tokens() == 36
+
+    # The turn does not fit, so the conversation goes down to three quarters
+    # of the budget, minus the new turn
+    window.begin_turn([3] * 5)
+    assert window.num_tokens() <= window.budget * 3 // 4 - 5
+    assert len(window.turns) == 4
+
+
+def test_a_turn_longer_than_the_budget_keeps_its_end():
+    window = ContextWindow([0, 1], max_tokens=10, reserved_tokens=2)
+    prompt = window.begin_turn(list(range(100, 120)))
+    assert prompt == [0, 1] + list(range(114, 120))
+
+
+def test_end_turn_without_begin_turn():
+    window = ContextWindow([0], max_tokens=10, reserved_tokens=2)
+    with pytest.raises(ValueError):
+        window.end_turn([1])
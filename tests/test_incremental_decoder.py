@@ -0,0 +1,37 @@
+"""Tests of the `IncrementalDecoder` class, which turns generated tokens into
+text one token at a time."""
+
+import pytest
+from transformers import AutoTokenizer
+
+from incremental_decoder import IncrementalDecoder
+
+TEXTS = [
+    "Hi! Can you help me plan a trip to Japan in spring?",
+    "  Spaces,\tand\nnew lines  ",
+    "Multi-byte characters: ¿Qué tal? 日本へ行きたい 🙂👍",
+]
+
+
+@pytest.fixture(name="tokenizer", scope="module")
+def fixture_tokenizer(tiny_model_dir):
+    return AutoTokenizer.from_pretrained(tiny_model_dir)
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_pushed_text_is_the_decoded_text(tokenizer, text):
+    ids = tokenizer.encode(text)
+    decoder = IncrementalDecoder(tokenizer)
+    fragments = [decoder.push(token_id) for token_id in ids]
+    assert "".join(fragments) == tokenizer.decode(ids)
+
+
+def test_incomplete_characters_are_not_returned(tokenizer):
+    ids = tokenizer.encode("🙂")
+    # The byte-level tokenizer has not seen the emoji, so it takes several
+    # tokens, and none of them but the last one completes it
+    assert len(ids) > 1
+    decoder = IncrementalDecoder(tokenizer)
+    fragments = [decoder.push(token_id) for token_id in ids]
+    assert fragments[:-1] == [""] * (len(ids) - 1)
+    assert fragments[-1] == "🙂"
@@ -0,0 +1,65 @@
+"""Tests of the `OnnxRuntimeBackend` class. It must give the same results as
+the PyTorch backend: the same logits after prefilling a prompt, and the same
+tokens when decoding greedily after it."""
+
+import os
+from typing import List
+
+import pytest
+import torch
+from transformers import AutoTokenizer
+
+from benchmark import MESSAGES, TINY_MODEL_NAME
+from cached_model import CachedModel
+from chat_bot import INITIAL_PROMPT, ChatBotConf
+from inference_backend import load_backend
+from model_configurations import ModelConfigurations
+
+# The export needs onnx, and running the model onnxruntime
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+NUM_TOKENS = 32
+
+
+@pytest.fixture(name="onnx_cache_dir", autouse=True)
+def fixture_onnx_cache_dir(tmp_path, monkeypatch):
+    """The models are exported to a temporary directory, not to the cache of
+    the user."""
+    import onnx_backend  # pylint: disable=import-outside-toplevel
+
+    monkeypatch.setattr(onnx_backend, "CACHE_DIR", str(tmp_path))
+    return str(tmp_path)
+
+
+def _greedy_decode(model: CachedModel, prompt_ids: List[int]) -> tuple:
+    """This function returns the logits for the last token of the prompt and
+    the tokens decoded greedily after it."""
+    first_logits = model.prefill(prompt_ids)
+    logits = first_logits
+    tokens = []
+    for _ in range(NUM_TOKENS):
+        tokens.append(int(logits.argmax()))
+        logits = model.forward([tokens[-1]])[-1]
+
+    return first_logits, tokens
+
+
+def test_backends_give_the_same_results(tiny_model_dir, onnx_cache_dir):
+    model_confs = ModelConfigurations(
+        os.path.join(tiny_model_dir, "model_confs.yaml")
+    )
+    conf = ChatBotConf(TINY_MODEL_NAME, model_confs)
+    tokenizer = AutoTokenizer.from_pretrained(tiny_model_dir)
+    prompt_ids = tokenizer.encode(INITIAL_PROMPT + MESSAGES[0])
+
+    expected_logits, expected_tokens = _greedy_decode(
+        CachedModel(load_backend("pytorch", tiny_model_dir, conf)), prompt_ids
+    )
+    logits, tokens = _greedy_decode(
+        CachedModel(load_backend("onnxruntime", tiny_model_dir, conf)), prompt_ids
+    )
+
+    assert os.listdir(onnx_cache_dir)
+    torch.testing.assert_close(logits, expected_logits, rtol=1e-3, atol=1e-3)
+    assert tokens == expected_tokens
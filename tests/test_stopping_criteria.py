@@ -0,0 +1,49 @@
+"""Tests of the helpers that end the answer on the markers of the
+conversation."""
+
+from stopping_criteria import cut_at_markers, has_new_marker, held_back_length
+
+MARKERS = ["<|endoftext|>", "<|prompter|>", "<|assistant|>"]
+
+
+def test_cut_at_markers_keeps_text_without_markers():
+    assert cut_at_markers("Hello there", MARKERS) == "Hello there"
+
+
+def test_cut_at_markers_cuts_at_the_first_marker():
+    text = "Hello<|prompter|>How are you?<|endoftext|>"
+    assert cut_at_markers(text, MARKERS) == "Hello"
+
+
+def test_held_back_length_without_partial_marker():
+    assert held_back_length("Hello there", MARKERS) == 0
+    assert held_back_length("", MARKERS) == 0
+
+
+def test_held_back_length_with_partial_marker():
+    assert held_back_length("Hello <", MARKERS) == 1
+    assert held_back_length("Hello <|pro", MARKERS) == len("<|pro")
+    # The longest possible beginning of any marker is held back
+    assert held_back_length("Hello <|", MARKERS) == 2
+
+
+def test_held_back_length_never_holds_back_a_whole_marker():
+    # A complete marker is cut by cut_at_markers, not held back
+    assert held_back_length("<|endoftext|>", MARKERS) < len("<|endoftext|>")
+
+
+def test_held_back_length_only_inspects_the_end():
+    assert held_back_length("<|pro Hello", MARKERS) == 0
+
+
+def test_has_new_marker_in_the_new_text():
+    assert has_new_marker("Hello<|prompter|>", MARKERS, len("ter|>"))
+    # A marker written with many small fragments is still found
+    assert has_new_marker("Hello<|prompter|>", MARKERS, 1)
+    assert has_new_marker("<|endoftext|> and more", MARKERS, len("<|endoftext|> and more"))
+
+
+def test_has_new_marker_ignores_old_and_partial_markers():
+    assert not has_new_marker("Hello<|prompter|> and more", MARKERS, len(" more"))
+    assert not has_new_marker("Hello <|prompt", MARKERS, 3)
+    assert not has_new_marker("Hello", MARKERS, 0)